@@ -0,0 +1,678 @@
+'''
+Gym Billing System - data generator and benchmarks
+Description: Writes synthetic members.txt/classes.txt files at any scale and times the core operations
+and reports of gym_billing.py against them. Results are written as JSON so runs can be compared.
+
+    python gym_bench.py generate DIR --members 100000 --sessions 500 --registrations 3
+    python gym_bench.py run --scales 1000,100000 --out results.json
+    python gym_bench.py compare baseline.json results.json
+    python gym_bench.py stress --processes 8 --checkins 50
+    python gym_bench.py snapshot --scales 10000,100000,1000000
+    python gym_bench.py replay --terminals 8 --steps 50
+'''
+import argparse
+import ast
+import builtins
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import gym_billing
+
+
+FIRST_NAMES = ["Lee", "Tyreek", "Aaliyah", "Kemar", "Shanice", "Andre", "Tanya", "Marcus", "Kimberly", "Damion",
+               "Nadine", "Omar", "Renee", "Jermaine", "Chevelle", "Ricardo", "Simone", "Dwayne", "Monique", "Kevin"]
+LAST_NAMES = ["Tian", "Johnson", "Brown", "Williams", "Campbell", "Thompson", "Clarke", "Reid", "Morgan", "Grant",
+              "Henry", "Walker", "Lewis", "Robinson", "Edwards", "Smith", "Stewart", "Bailey", "Gordon", "Wright"]
+CLASS_NAMES = ["Spinning", "Martial Arts", "Yoga", "Pilates", "Zumba", "Boxing", "CrossFit", "Aerobics",
+               "Aqua Fit", "Kickboxing", "Step", "HIIT", "Boot Camp", "Stretching", "Circuit Training"]
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+TIMES = ["Morning", "Evening"]
+# Rough share of each membership type among members
+TIER_WEIGHTS = {"Platinum": 1, "Diamond": 2, "Gold": 3, "Standard": 4}
+
+
+# Replay: simulated front desks that run the interactive menu from input scripts, see replay()
+MENU_OPERATIONS = {"1": "checkin", "2": "add_member", "3": "session", "4": "add_instructor", "5": "report", "6": "exit"}
+# Relative share of each menu action in generated scripts
+REPLAY_MIX = {"checkin": 6, "add_member": 2, "session": 1, "report": 1}
+
+
+class ScriptedTerminal:
+    #Stands in for the keyboard of one desk: input() returns the next line of the script. Every menu action is
+    #timed from the choice made at the main menu to the next main menu prompt, the login from its first prompt
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.timings = []  # (operation, seconds)
+        self.operation = "login"
+        self.started = None
+        self.fed = 0
+
+    def input(self, prompt=""):
+        now = time.perf_counter()
+        at_menu = sys._getframe(1).f_code.co_name == "display_menu"
+        if at_menu:
+            self.finish(now)
+        try:
+            line = next(self.lines)
+        except StopIteration:
+            raise EOFError("input script ended") from None
+        self.fed += 1
+        if at_menu:
+            self.operation = MENU_OPERATIONS.get(line, "invalid")
+        if at_menu or self.started is None:
+            self.started = time.perf_counter()
+        return line
+
+    def finish(self, now=None):
+        #Records the action in progress, if any
+        if self.operation is not None and self.started is not None:
+            self.timings.append((self.operation, (now or time.perf_counter()) - self.started))
+        self.operation = None
+
+
+def replay_terminal(task):
+    #One simulated desk: logs in and runs the menu on its script, with the output discarded
+    data_dir, lines, settings = task
+    os.chdir(data_dir)
+    for name, value in settings.items():
+        setattr(gym_billing, name, value)
+    terminal = ScriptedTerminal(lines)
+    builtins.input = terminal.input
+    start = time.time()
+    finished = False
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            if gym_billing.login():
+                gym_billing.display_menu()
+        except SystemExit:
+            finished = True  # the script ended with Exit
+        except EOFError:
+            pass
+    terminal.finish()
+    return {"timings": terminal.timings, "start": start, "end": time.time(), "finished": finished,
+            "fed": terminal.fed, "lines": len(lines)}
+
+def replay_scripts(store, terminals, steps, mix=REPLAY_MIX, seed=1):
+    #Generates one input script per terminal, returns (scripts, expected). Each terminal checks in its own share
+    #of the members, for classes they are not registered for yet, and adds and updates its own sessions, so the
+    #scripts never collide on a choice; expected lists what the data must hold once they have all run
+    rng = random.Random(seed)
+    member_ids = list(store.members)
+    classes = [class_id for class_id, gym_class in store.scheduled_classes().items() if gym_class.capacity is None]
+    tiers, tier_weights = list(TIER_WEIGHTS), list(TIER_WEIGHTS.values())
+    operations, weights = list(mix), list(mix.values())
+    scripts = []
+    expected = {"registrations": [], "members": [], "sessions": {}}
+    for terminal in range(terminals):
+        lines = ["Admin", "Admin12!"]
+        own_members = member_ids[terminal::terminals]
+        own_sessions = []
+        for step in range(steps):
+            operation = rng.choices(operations, weights)[0]
+            if operation == "checkin" and own_members and classes:
+                member_id = rng.choice(own_members)
+                taken = set(store.members[member_id].classes)
+                taken.update(c for m, c in expected["registrations"] if m == member_id)
+                free = [class_id for class_id in classes if class_id not in taken]
+                if free:
+                    class_id = rng.choice(free)
+                    lines += ["1", member_id, class_id]
+                    expected["registrations"].append((member_id, class_id))
+            elif operation == "add_member":
+                first, last = f"Replay{terminal}", f"Desk{step}"
+                lines += ["2", first, last, f"876{rng.randrange(10 ** 7):07d}", rng.choices(tiers, tier_weights)[0]]
+                expected["members"].append((first, last))
+            elif operation == "session":
+                cost = str(rng.randrange(500, 2001, 50))
+                if own_sessions and rng.random() < 0.5:
+                    session_id = rng.choice(own_sessions)
+                    lines += ["3", "2", session_id, "", "", "", cost, "", ""]
+                else:
+                    session_id = f"C{5000 + terminal * 50 + len(own_sessions)}"
+                    if len(own_sessions) == 50:
+                        continue
+                    own_sessions.append(session_id)
+                    lines += ["3", "1", session_id, rng.choice(CLASS_NAMES), rng.choice(DAYS), rng.choice(TIMES), cost,
+                              rng.choice(FIRST_NAMES), ""]
+                expected["sessions"][session_id] = cost
+            elif operation == "report":
+                report = rng.choice("12345")
+                lines += ["5", report] + (["", ""] if report == "2" else [])  # the schedule asks for a day and instructor
+        lines += ["6", "y"]
+        scripts.append(lines)
+    return scripts, expected
+
+def replay_check(store, expected):
+    #Lines describing every expected registration, member and session that is missing or stored more than once
+    problems = []
+    counts = registration_counts(store)
+    for member_id, class_id in expected["registrations"]:
+        found = counts.get((member_id, class_id), 0)
+        if found != 1:
+            problems.append(f"registration {member_id} {class_id}: found {found} times")
+    names = {}
+    for member in store.members.values():
+        names[member.first_name, member.last_name] = names.get((member.first_name, member.last_name), 0) + 1
+    for name in expected["members"]:
+        if names.get(name, 0) != 1:
+            problems.append(f"member {' '.join(name)}: found {names.get(name, 0)} times")
+    for session_id, cost in expected["sessions"].items():
+        gym_class = store.classes.get(session_id)
+        if gym_class is None or gym_class.cost_text != cost:
+            problems.append(f"session {session_id}: expected cost {cost}, found "
+                            f"{gym_class.cost_text if gym_class is not None else 'no session'}")
+    return problems
+
+def percentile(values, fraction):
+    #Nearest-rank percentile of sorted values
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+def replay(data_dir, terminals, scripts, expected=None, settings=None):
+    #Runs the scripts on terminals concurrent desks against data_dir (terminal i runs script i modulo their
+    #number), then checks the data. Returns latency percentiles per operation, throughput and the problems found
+    tasks = [(data_dir, scripts[i % len(scripts)], settings or {}) for i in range(terminals)]
+    with multiprocessing.Pool(terminals) as pool:
+        results = pool.map(replay_terminal, tasks)
+    seconds = max(r["end"] for r in results) - min(r["start"] for r in results)
+    timings = {}
+    for result in results:
+        for operation, elapsed in result["timings"]:
+            timings.setdefault(operation, []).append(elapsed)
+    operations = {}
+    for operation, values in sorted(timings.items()):
+        values.sort()
+        operations[operation] = {"count": len(values), "p50": percentile(values, 0.5), "p90": percentile(values, 0.9),
+                                 "p99": percentile(values, 0.99), "max": values[-1]}
+    actions = sum(len(v) for o, v in timings.items() if o not in ("login", "exit"))
+    os.chdir(data_dir)
+    store = gym_billing.GymStore.load()
+    problems = [f"terminal {i}: script stopped after {r['fed']} of {r['lines']} lines"
+                for i, r in enumerate(results) if not r["finished"]]
+    problems += replay_check(store, expected) if expected else []
+    problems += gym_billing.Aggregates.build(store).drift(gym_billing.Aggregates.load())
+    return {
+        "terminals": terminals,
+        "seconds": seconds,
+        "actions": actions,
+        "actions_per_second": actions / seconds if seconds else 0.0,
+        "operations": operations,
+        "problems": problems,
+    }
+
+
+def generate(data_dir, members, sessions, registrations, instructors=None, seed=1):
+    #Writes members.txt and classes.txt with the given number of members and sessions. Every member is
+    #registered for 0 to 2 * registrations classes, registrations on average
+    rng = random.Random(seed)
+    if instructors is None:
+        instructors = max(2, sessions // 5)
+    os.makedirs(data_dir, exist_ok=True)
+    for filename in os.listdir(data_dir):
+        if filename.endswith(".journal") or filename in ("ids.txt", "aggregates.txt"):
+            os.remove(os.path.join(data_dir, filename))
+
+    instructor_names = []
+    class_ids = [f"C{i:04d}" for i in range(1, sessions + 1)]
+    tiers = list(TIER_WEIGHTS)
+    weights = list(TIER_WEIGHTS.values())
+    with open(os.path.join(data_dir, "members.txt"), "w") as f:
+        for i in range(instructors):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            instructor_names.append(first)
+            f.write(f"I{1000 + i},{first},{last},876{rng.randrange(10 ** 7):07d},"
+                    f"{rng.randrange(10 ** 8, 10 ** 9)},{rng.randint(1, 28):02d}{rng.randint(1, 12):02d}{rng.randint(1960, 2005)}\n")
+        for i in range(members):
+            count = rng.randint(0, 2 * registrations) if class_ids else 0
+            classes = "".join("," + rng.choice(class_ids) for _ in range(count))
+            f.write(f"M{1000 + i},{rng.choice(FIRST_NAMES)},{rng.choice(LAST_NAMES)},876{rng.randrange(10 ** 7):07d},"
+                    f"{rng.choices(tiers, weights)[0]}{classes}\n")
+    with open(os.path.join(data_dir, "classes.txt"), "w") as f:
+        for class_id in class_ids:
+            f.write(f"{class_id},{rng.choice(CLASS_NAMES)},{rng.choice(DAYS)},{rng.choice(TIMES)},"
+                    f"{rng.randrange(500, 2001, 50)},{rng.choice(instructor_names)}\n")
+
+
+# Benchmarked operations. Each is called with a copy of the dataset as the current directory and
+# returns a function that performs the timed part, so any setup is left out of the timing
+
+def op_load_members():
+    return lambda: gym_billing.load("members.txt")
+
+def op_load_classes():
+    return lambda: gym_billing.load("classes.txt")
+
+def op_save_members():
+    members = gym_billing.load("members.txt")
+    return lambda: gym_billing.save("members.txt", members)
+
+def op_store_load():
+    return gym_billing.GymStore.load
+
+def op_checkin():
+    # what checkin() does after the prompts: load the store, register the member and commit
+    def run():
+        store = gym_billing.GymStore.load()
+        member_id = next(iter(store.members))
+        store.register(member_id, next(iter(store.classes)))
+        store.commit()
+    return run
+
+def op_add_member():
+    # what add_memb() does after the prompts
+    def run():
+        store = gym_billing.GymStore.load()
+        gym_billing.batch_add_member(store, ["Bench", "Mark", "8760000000", "Gold"])
+        store.commit()
+    return run
+
+def report_op(name):
+    # print_report() loads the store and runs one report, the output is discarded. The report cache would
+    # answer every repeat, so it is off to time the report itself
+    def setup():
+        gym_billing.REPORT_CACHE.enabled = False
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                gym_billing.REPORTS[name](gym_billing.GymStore.load())
+        return run
+    return setup
+
+OPERATIONS = {
+    "load_members": op_load_members,
+    "load_classes": op_load_classes,
+    "save_members": op_save_members,
+    "store_load": op_store_load,
+    "checkin": op_checkin,
+    "add_member": op_add_member,
+    "report_members": report_op("members"),
+    "report_schedule": report_op("schedule"),
+    "report_membership": report_op("membership"),
+    "report_registrations": report_op("registrations"),
+    "report_clients": report_op("clients"),
+}
+
+
+def measure(data_dir, work_dir, setup, repeat):
+    #Times one operation repeat times on a fresh copy of the dataset, then runs it once more under
+    #tracemalloc for its peak memory. Returns (timings in seconds, peak bytes)
+    timings = []
+    peak = 0
+    for attempt in range(repeat + 1):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        shutil.copytree(data_dir, work_dir)
+        os.chdir(work_dir)
+        run = setup()
+        if attempt < repeat:
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        else:
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return timings, peak
+
+
+def run_benchmarks(scales, sessions, registrations, repeat, operations=None, work_dir=None, seed=1):
+    #Generates one dataset per scale and benchmarks every operation on it, returns the results document
+    operations = operations or list(OPERATIONS)
+    start_dir = os.getcwd()
+    base_dir = work_dir or tempfile.mkdtemp(prefix="gym_bench_")
+    results = []
+    try:
+        for members in scales:
+            data_dir = os.path.join(base_dir, f"data-{members}")
+            generate(data_dir, members, sessions, registrations, seed=seed)
+            # store the running totals once, as on a desk that has been in use for a while
+            os.chdir(data_dir)
+            gym_billing.GymStore.load().aggregates()
+            for name in operations:
+                timings, peak = measure(data_dir, os.path.join(base_dir, "work"), OPERATIONS[name], repeat)
+                results.append({
+                    "operation": name,
+                    "members": members,
+                    "sessions": sessions,
+                    "registrations": registrations,
+                    "runs": repeat,
+                    "seconds_min": min(timings),
+                    "seconds_median": statistics.median(timings),
+                    "peak_bytes": peak,
+                })
+                print(f"{name:22} {members:>9} members  {min(timings) * 1000:10.2f} ms  "
+                      f"{peak / 1024 / 1024:8.1f} MiB", file=sys.stderr)
+    finally:
+        os.chdir(start_dir)
+        if work_dir is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": gym_billing.numpy is not None,
+        "results": results,
+    }
+
+
+def retained_bytes(build):
+    #Memory still held by the object that build() returns, measured with tracemalloc
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+def memory_comparison(data_dir):
+    #Memory of the members as the dict of lists returned by load(), as the compact records of the
+    #store, and as the whole store with its indexes
+    start_dir = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        def records():
+            people = {}
+            for person_id, fields in gym_billing.load("members.txt").items():
+                record_type = gym_billing.Member if person_id.startswith("M") else gym_billing.Instructor
+                people[person_id] = record_type.from_fields(person_id, fields)
+            return people
+        return {
+            "dict_of_lists": retained_bytes(lambda: gym_billing.load("members.txt")),
+            "records": retained_bytes(records),
+            "store": retained_bytes(gym_billing.GymStore.load),
+        }
+    finally:
+        os.chdir(start_dir)
+
+
+def snapshot_comparison(data_dir, repeat):
+    #Fastest load time of the data files and of the whole store, from the CSV files and from their binary
+    #snapshots. Returns {what: {"csv": seconds, "snapshot": seconds}}
+    start_dir = os.getcwd()
+    os.chdir(data_dir)
+    try:
+        # the snapshots are written the way a save writes them
+        for filename in gym_billing.SNAPSHOT_FILES:
+            gym_billing.Snapshot(filename).write(gym_billing.read_records(filename, {}))
+        loads = {
+            "load_members": lambda: gym_billing.load("members.txt"),
+            "load_classes": lambda: gym_billing.load("classes.txt"),
+            "store_load": gym_billing.GymStore.load,
+        }
+        results = {}
+        for name, run in loads.items():
+            results[name] = {}
+            for source, enabled in (("csv", False), ("snapshot", True)):
+                gym_billing.SNAPSHOTS = enabled
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    run()
+                    timings.append(time.perf_counter() - start)
+                results[name][source] = min(timings)
+        return results
+    finally:
+        gym_billing.SNAPSHOTS = True
+        os.chdir(start_dir)
+
+
+def compare(baseline, current, threshold):
+    #Lines comparing the fastest time of every operation, returns (lines, number of regressions)
+    before = {(r["operation"], r["members"]): r for r in baseline["results"]}
+    lines, regressions = [], 0
+    for result in current["results"]:
+        old = before.get((result["operation"], result["members"]))
+        if old is None:
+            continue
+        ratio = result["seconds_min"] / old["seconds_min"] if old["seconds_min"] else 1.0
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        lines.append(f"{result['operation']:22} {result['members']:>9}  {old['seconds_min'] * 1000:10.2f} ms -> "
+                     f"{result['seconds_min'] * 1000:10.2f} ms  x{ratio:.2f}{flag}")
+    return lines, regressions
+
+
+# Concurrency stress test: several processes check members in at the same time against one data directory,
+# through the store (load, register, commit), the indexed check-in path or its group commit
+
+STRESS_MODES = ("store", "indexed", "group")
+
+
+def stress_worker(task):
+    #One front desk: performs its check-ins one at a time, the way separate interactive sessions would
+    data_dir, mode, checkins = task
+    os.chdir(data_dir)
+    gym_billing.GROUP_COMMIT = mode == "group"
+    for member_id, class_id in checkins:
+        if mode == "store":
+            store = gym_billing.GymStore.load()
+            store.register(member_id, class_id)
+            store.commit()
+        elif mode == "group":
+            gym_billing.queue_checkin(member_id, class_id)
+        else:
+            gym_billing.register_records([(member_id, class_id)])
+    return len(checkins)
+
+def registration_counts(store):
+    counts = {}
+    for member_id, member in store.members.items():
+        for class_id in member.classes:
+            counts[member_id, class_id] = counts.get((member_id, class_id), 0) + 1
+    return counts
+
+def stress(data_dir, processes, checkins, modes=STRESS_MODES, hot_members=20, seed=1):
+    #Runs processes workers with checkins check-ins each, spread over a few members so that the writes
+    #collide, then checks that every registration arrived exactly once and the stored totals still match.
+    #A member checked in twice for the same class is refused the second time, so each pair counts once
+    rng = random.Random(seed)
+    os.chdir(data_dir)
+    store = gym_billing.GymStore.load()
+    store.aggregates()
+    before = registration_counts(store)
+    members = list(store.members)[:hot_members]
+    classes = list(store.scheduled_classes())
+    tasks = []
+    expected = dict(before)
+    for i in range(processes):
+        plan = [(rng.choice(members), rng.choice(classes)) for _ in range(checkins)]
+        for key in plan:
+            expected[key] = expected.get(key, 0) or 1
+        tasks.append((data_dir, modes[i % len(modes)], plan))
+    start = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        pool.map(stress_worker, tasks)
+    seconds = time.perf_counter() - start
+    os.chdir(data_dir)
+    store = gym_billing.GymStore.load()
+    actual = registration_counts(store)
+    keys = set(expected) | set(actual)
+    return {
+        "processes": processes,
+        "checkins": processes * checkins,
+        "seconds": seconds,
+        "lost": sum(max(0, expected.get(key, 0) - actual.get(key, 0)) for key in keys),
+        "duplicated": sum(max(0, actual.get(key, 0) - expected.get(key, 0)) for key in keys),
+        "drift": gym_billing.Aggregates.build(store).drift(gym_billing.Aggregates.load()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="gym_bench.py", description="Gym Billing data generator and benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("generate", help="write members.txt and classes.txt into a directory")
+    command.add_argument("data_dir")
+    command.add_argument("--members", type=int, default=1000)
+    command.add_argument("--sessions", type=int, default=200)
+    command.add_argument("--registrations", type=int, default=2, help="average classes per member")
+    command.add_argument("--instructors", type=int)
+    command.add_argument("--seed", type=int, default=1)
+
+    command = commands.add_parser("run", help="benchmark every operation at the given scales")
+    command.add_argument("--scales", default="1000,100000", help="comma separated member counts")
+    command.add_argument("--sessions", type=int, default=200)
+    command.add_argument("--registrations", type=int, default=2)
+    command.add_argument("--repeat", type=int, default=3)
+    command.add_argument("--operations", help=f"comma separated subset of: {', '.join(OPERATIONS)}")
+    command.add_argument("--work-dir", help="keep the generated datasets here instead of a temp directory")
+    command.add_argument("--out", help="write the results to this JSON file (default: stdout)")
+
+    command = commands.add_parser("memory", help="compare the memory of load()'s dict of lists with the store records")
+    command.add_argument("--members", type=int, default=100000)
+    command.add_argument("--sessions", type=int, default=200)
+    command.add_argument("--registrations", type=int, default=2)
+
+    command = commands.add_parser("replay", help="run the interactive menu from input scripts on many desks at once")
+    command.add_argument("--terminals", type=int, default=8, help="concurrent simulated desks")
+    command.add_argument("--steps", type=int, default=50, help="menu actions per generated script")
+    command.add_argument("--mix", default=",".join(f"{k}={v}" for k, v in REPLAY_MIX.items()),
+                         help="relative share of each action in generated scripts")
+    command.add_argument("--script", action="append",
+                         help="replay this recorded input script (one input line per line) instead of generated "
+                              "ones, may be given once per desk")
+    command.add_argument("--data-dir", help="copy this data directory instead of generating one")
+    command.add_argument("--members", type=int, default=2000)
+    command.add_argument("--sessions", type=int, default=50)
+    command.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                         help="set a gym_billing setting in every desk, e.g. JOURNAL_MODE=False")
+    command.add_argument("--seed", type=int, default=1)
+    command.add_argument("--out", help="also write the results to this JSON file")
+
+    command = commands.add_parser("snapshot", help="compare load times from the CSV files and their binary snapshots")
+    command.add_argument("--scales", default="10000,100000,1000000", help="comma separated member counts")
+    command.add_argument("--sessions", type=int, default=200)
+    command.add_argument("--registrations", type=int, default=2)
+    command.add_argument("--repeat", type=int, default=3)
+
+    command = commands.add_parser("compare", help="compare two result files")
+    command.add_argument("baseline")
+    command.add_argument("current")
+    command.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as a regression")
+
+    command = commands.add_parser("stress", help="concurrent check-ins from many processes, checked for lost updates")
+    command.add_argument("--processes", type=int, default=8)
+    command.add_argument("--checkins", type=int, default=50, help="check-ins per process")
+    command.add_argument("--modes", default=",".join(STRESS_MODES), help="write paths the processes take turns using")
+    command.add_argument("--members", type=int, default=1000)
+    command.add_argument("--sessions", type=int, default=50)
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        generate(args.data_dir, args.members, args.sessions, args.registrations, args.instructors, args.seed)
+        return 0
+    if args.command == "run":
+        scales = [int(n) for n in args.scales.split(",")]
+        operations = args.operations.split(",") if args.operations else None
+        document = run_benchmarks(scales, args.sessions, args.registrations, args.repeat, operations,
+                                  os.path.abspath(args.work_dir) if args.work_dir else None)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(document, f, indent=2)
+        else:
+            json.dump(document, sys.stdout, indent=2)
+        return 0
+    if args.command == "memory":
+        data_dir = tempfile.mkdtemp(prefix="gym_bench_")
+        try:
+            generate(data_dir, args.members, args.sessions, args.registrations)
+            sizes = memory_comparison(data_dir)
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        for name, size in sizes.items():
+            print(f"{name:14} {size / 1024 / 1024:8.1f} MiB  {size / args.members:6.0f} bytes/member")
+        return 0
+    if args.command == "snapshot":
+        print(f"{'':14} {'members':>9}  {'csv':>10}  {'snapshot':>10}")
+        for members in (int(n) for n in args.scales.split(",")):
+            data_dir = tempfile.mkdtemp(prefix="gym_bench_")
+            try:
+                generate(data_dir, members, args.sessions, args.registrations)
+                results = snapshot_comparison(data_dir, args.repeat)
+            finally:
+                shutil.rmtree(data_dir, ignore_errors=True)
+            for name, times in results.items():
+                print(f"{name:14} {members:>9}  {times['csv'] * 1000:7.1f} ms  {times['snapshot'] * 1000:7.1f} ms  "
+                      f"x{times['csv'] / times['snapshot']:.1f}")
+        return 0
+    if args.command == "replay":
+        settings = {}
+        for setting in args.set:
+            name, _, value = setting.partition("=")
+            if not hasattr(gym_billing, name):
+                parser.error(f"gym_billing has no setting {name}")
+            settings[name] = ast.literal_eval(value)
+        recorded = []
+        for filename in args.script or ():
+            with open(filename) as f:
+                recorded.append(f.read().splitlines())
+        start_dir = os.getcwd()
+        work_dir = tempfile.mkdtemp(prefix="gym_replay_")
+        data_dir = os.path.join(work_dir, "data")
+        try:
+            if args.data_dir:
+                shutil.copytree(args.data_dir, data_dir)
+            else:
+                generate(data_dir, args.members, args.sessions, 2, seed=args.seed)
+            os.chdir(data_dir)
+            store = gym_billing.GymStore.load()
+            store.aggregates()
+            if recorded:
+                scripts, expected = recorded, None
+            else:
+                mix = {name: int(weight) for name, weight in (part.split("=") for part in args.mix.split(","))}
+                scripts, expected = replay_scripts(store, args.terminals, args.steps, mix, args.seed)
+            result = replay(data_dir, args.terminals, scripts, expected, settings)
+        finally:
+            os.chdir(start_dir)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"{result['actions']} menu actions from {result['terminals']} desks in {result['seconds']:.2f} s "
+              f"({result['actions_per_second']:.1f}/s)")
+        print(f"{'':16} {'count':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for operation, stats in result["operations"].items():
+            print(f"{operation:16} {stats['count']:6d} " +
+                  " ".join(f"{stats[p] * 1000:6.1f} ms" for p in ("p50", "p90", "p99", "max")))
+        print(f"problems: {len(result['problems'])}")
+        for line in result["problems"]:
+            print(line)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(result, f, indent=2)
+        return 1 if result["problems"] else 0
+    if args.command == "stress":
+        data_dir = tempfile.mkdtemp(prefix="gym_stress_")
+        try:
+            generate(data_dir, args.members, args.sessions, 2)
+            result = stress(data_dir, args.processes, args.checkins, args.modes.split(","))
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        print(f"{result['checkins']} check-ins from {result['processes']} processes in {result['seconds']:.2f} s")
+        print(f"lost: {result['lost']}  duplicated: {result['duplicated']}")
+        for line in result["drift"]:
+            print(line)
+        return 1 if result["lost"] or result["duplicated"] or result["drift"] else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    lines, regressions = compare(baseline, current, args.threshold)
+    print("\n".join(lines))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
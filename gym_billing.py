@@ -4,315 +4,2343 @@ Authors: Antonio Rolong, Keno Williams, Zoe-Ann Turner
 Date: 2025-03-21
 Description: A program that allows gym members to check-in, add new members, add/update sessions, add facilitators/instructors, print reports, and exit the program.
 '''
-import random
+import argparse
+import asyncio
+import atexit
+import bisect
+import collections
+import contextlib
+import csv
+import functools
+import gc
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
 import datetime
-from datetime import datetime
+from array import array
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Month-end totals use the array-backed billing engine when NumPy is installed
+USE_NUMPY = True
+
+
+class Metrics:
+    #Call counts, latency histograms and byte/record counters of the storage layer, the menu actions and
+    #the reports. Nothing is recorded unless enabled, see enable_metrics()
+    BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.calls = {}     # operation -> number of calls
+        self.seconds = {}   # operation -> total seconds
+        self.buckets = {}   # operation -> count per upper bound in BUCKETS
+        self.counters = {}  # (counter, label) -> total
+
+    def observe(self, operation, seconds):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.seconds[operation] = self.seconds.get(operation, 0.0) + seconds
+            buckets = self.buckets.setdefault(operation, [0] * len(self.BUCKETS))
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+
+    def add(self, counter, label, amount):
+        with self.lock:
+            self.counters[counter, label] = self.counters.get((counter, label), 0) + amount
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps({
+                "operations": {operation: {
+                    "calls": self.calls[operation],
+                    "seconds": self.seconds[operation],
+                    "buckets": dict(zip([str(b) for b in self.BUCKETS], self.buckets[operation])),
+                } for operation in self.calls},
+                "counters": [{"counter": counter, "label": label, "value": value}
+                             for (counter, label), value in self.counters.items()],
+            }, indent=2)
+
+    def to_prometheus(self):
+        with self.lock:
+            lines = ["# TYPE gym_operation_seconds histogram"]
+            for operation in self.calls:
+                for bound, count in zip(self.BUCKETS, self.buckets[operation]):
+                    lines.append(f'gym_operation_seconds_bucket{{operation="{operation}",le="{bound}"}} {count}')
+                lines.append(f'gym_operation_seconds_bucket{{operation="{operation}",le="+Inf"}} {self.calls[operation]}')
+                lines.append(f'gym_operation_seconds_sum{{operation="{operation}"}} {self.seconds[operation]}')
+                lines.append(f'gym_operation_seconds_count{{operation="{operation}"}} {self.calls[operation]}')
+            for counter in sorted({counter for counter, _ in self.counters}):
+                lines.append(f"# TYPE gym_{counter}_total counter")
+                for (name, label), value in self.counters.items():
+                    if name == counter:
+                        lines.append(f'gym_{counter}_total{{file="{label}"}} {value}')
+            return "\n".join(lines) + "\n"
+
+    def dump(self, filename):
+        #Writes the metrics as JSON for a .json file name, in the Prometheus text format otherwise
+        text = self.to_json() if filename.endswith(".json") else self.to_prometheus()
+        with open(filename + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(filename + ".tmp", filename)
+
+
+METRICS = Metrics()
+
+
+def timed(operation):
+    #Decorator that records the latency of every call when metrics are enabled,
+    #when they are not it only costs one attribute check per call
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.observe(operation, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def count(counter, label, amount=1):
+    if METRICS.enabled:
+        METRICS.add(counter, label, amount)
+
+def enable_metrics(filename, interval=None):
+    #Starts recording metrics and writes them to filename on exit and, with an interval, every interval seconds
+    METRICS.enabled = True
+    atexit.register(METRICS.dump, filename)
+    if interval:
+        def dump_periodically():
+            while True:
+                time.sleep(interval)
+                METRICS.dump(filename)
+        threading.Thread(target=dump_periodically, daemon=True).start()
+
+
+# Journal mode: mutations are appended to a small change log next to the data file
+# instead of rewriting the whole file, the log is folded back into the file once it grows
+JOURNAL_MODE = True
+JOURNAL_COMPACT_BYTES = 64 * 1024
+
+
+def journal_name(filename):
+    #Name of the change journal kept next to a data file
+    return filename + ".journal"
+
+
+class FileLock:
+    #Advisory lock on a lock file shared by every process working on the same data, re-entrant within a
+    #process. Readers take it shared, writers exclusive. Without fcntl (Windows) only threads are coordinated
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def acquire(self, shared=False):
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            self.file = open(self.filename, "a")
+            fcntl.flock(self.file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+    @contextlib.contextmanager
+    def held(self, shared=False):
+        self.acquire(shared)
+        try:
+            yield self
+        finally:
+            self.release()
 
 
-def load(filename):
-    #Loads csv data from files into a list, creates empty file if file is not present
-    if filename == "members.txt":
+LOCKS = {}  # absolute lock file name -> FileLock
+
+
+def data_lock(shared=False):
+    #Holds the lock of the current data (see the backend's lock_name()) for a with block:
+    #exclusive around every write, shared around full loads
+    filename = os.path.abspath(BACKEND.lock_name())
+    if filename not in LOCKS:
+        LOCKS[filename] = FileLock(filename)
+    return LOCKS[filename].held(shared)
+
+
+def file_version(filename):
+    #(size, mtime) of a file, None when it does not exist
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Report cache: computed reports stored as JSON lines files in REPORT_CACHE_DIR, keyed on the report and
+# a fingerprint of the data files (size, mtime and content hash). Least recently used results are dropped
+# once the cache passes REPORT_CACHE_BYTES
+REPORT_CACHE_DIR = ".report_cache"
+REPORT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class ReportCache:
+    def __init__(self, directory=REPORT_CACHE_DIR, limit=REPORT_CACHE_BYTES):
+        self.directory = directory
+        self.limit = limit
+        self.enabled = True
+        self.hashes = {}  # absolute file name -> (size, mtime, sha256) hashed by this process
+
+    def forget(self):
+        #Called by every save and journal write: the next lookup hashes the files again
+        self.hashes.clear()
+
+    def file_hash(self, filename):
+        version = file_version(filename)
+        if version is None:
+            return "missing"
+        key = os.path.abspath(filename)
+        known = self.hashes.get(key)
+        if known is not None and known[:2] == version:
+            return known[2]
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.hashes[key] = version + (digest.hexdigest(),)
+        return digest.hexdigest()
+
+    def key(self, name):
+        #Cache key of the report for the data as it is now, None while the cache is disabled
+        if not self.enabled:
+            return None
+        parts = [name] + [f"{filename}:{file_version(filename)}:{self.file_hash(filename)}"
+                          for filename in BACKEND.data_files()]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        #The cached (summary, rows) stored under key, None when there is none. The rows are read from the
+        #entry as they are used. A hit touches the entry's modification time, which is its last use
+        if key is None:
+            return None
+        filename = os.path.join(self.directory, key + ".jsonl")
+        try:
+            f = open(filename)
+            summary = json.loads(f.readline())
+        except FileNotFoundError:
+            count("report_cache", "miss")
+            return None
+        except ValueError:
+            f.close()
+            count("report_cache", "miss")
+            return None
         try:
-            with open(filename, "r") as f:
-                members = f.read()
-                members = members.split("\n")
-                members = [i.split(",") for i in members]
-                members = {i[0]: i[1:] for i in members}
+            os.utime(filename)
         except FileNotFoundError:
-            with open(filename, "w") as f:
-                members = {}
-        return members
-
-    if filename == "classes.txt":
-        try: 
-            with open(filename, "r") as f:
-                classes = f.read()
-                classes = classes.split("\n")
-                classes = [i.split(",") for i in classes]
-                classes = {i[0]: i[1:] for i in classes}
+            pass  # evicted by another process since, the open file still reads
+        count("report_cache", "hit")
+        return summary, self.read_rows(f)
+
+    def read_rows(self, f):
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    def put(self, key, summary, rows):
+        #Passes the rows of a report on while storing them, one JSON line each after the summary, under the key
+        #taken before it was computed, so a change made in the meantime only leaves an entry that is never hit.
+        #The entry is only kept once every row went through: a report abandoned part way leaves nothing
+        if key is None:
+            yield from rows
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, key + ".jsonl")
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", buffering=1 << 20) as f:
+                f.write(json.dumps(summary) + "\n")
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+                    yield row
+                size = f.tell()
+            os.replace(tmp, filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict(key, size)
+
+    def evict(self, keep, kept_size):
+        #Removes the least recently used entries until the cache fits in its limit. The sizes and last uses are
+        #read from the directory itself, so entries written by processes running at the same time all count
+        entries = []
+        with os.scandir(self.directory) as listing:
+            for entry in listing:
+                if entry.name.endswith(".jsonl") and entry.name != keep + ".jsonl":
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = kept_size + sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.limit:
+                break
+            total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+REPORT_CACHE = ReportCache()
+
+
+def read_records(filename, records, whole_lines=False):
+    #Reads csv lines from a file into a dict keyed on the first field, later lines replace earlier ones.
+    #whole_lines=True skips a last line without its newline: what is left of a journal append that was cut short
+    parsed = 0
+    with open(filename, "r") as f:
+        for line in f:
+            if whole_lines and not line.endswith("\n"):
+                count("torn_lines", filename)
+                continue
+            line = line.rstrip("\n")
+            if line:
+                parts = line.split(",")
+                records[parts[0]] = parts[1:]
+                parsed += 1
+        count("bytes_read", filename, f.tell())
+    count("records_parsed", filename, parsed)
+    return records
+
+
+class TextBackend:
+    #The default storage: members.txt/classes.txt as CSV snapshots plus their change journals
+    aggregate_queries = False
+
+    def load(self, filename):
+        #Loads csv data from files into a dict, replays the change journal over the last snapshot,
+        #creates empty file if file is not present
+        records = None
+        if SNAPSHOTS and filename in SNAPSHOT_FILES:
+            records = load_snapshot(filename)
+        if records is None:
+            records = {}
+            try:
+                read_records(filename, records)
+            except FileNotFoundError:
+                with open(filename, "w") as f:
+                    pass
+        try:
+            read_records(journal_name(filename), records, whole_lines=True)
         except FileNotFoundError:
-            with open(filename, "w") as f:
-                classes = {}
-        return classes
+            pass
+        return records
 
-def save(filename, ulist):
-    #Saves data from lists into files in CSV format, creates file if not already present
-    if filename == "members.txt":
+    def lock_name(self):
+        return "gym.lock"
 
-        with open("members.txt", "w") as f:
-            for i in ulist:
-                f.write(i + "," + ",".join(ulist[i]) + "\n")
+    def data_files(self):
+        #Files whose contents the reports depend on
+        return [name for filename in VERSIONED_FILES for name in (filename, journal_name(filename))]
+
+    def version(self, filenames):
+        #Changes whenever any of the files or their journals is written, by this or another process
+        return [(file_version(filename), file_version(journal_name(filename))) for filename in filenames]
 
-    if filename == "classes.txt":
-        with open("classes.txt", "w") as f:
+    def save(self, filename, ulist):
+        #Saves data from dicts into files in CSV format, creates file if not already present.
+        #The snapshot is written to a temporary file and renamed over the old one, so readers never see
+        #half a file. A full save is a fresh snapshot, so the change journal is no longer needed
+        with open(filename + ".tmp", "w") as f:
             for i in ulist:
                 f.write(i + "," + ",".join(ulist[i]) + "\n")
+            count("bytes_written", filename, f.tell())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + ".tmp", filename)
+        if filename in INDEXED_FILES:
+            MemberIndex(filename).build()
+        if SNAPSHOTS and filename in SNAPSHOT_FILES:
+            Snapshot(filename).write(ulist)
+        try:
+            os.remove(journal_name(filename))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def journal(self, filename, ulist, keys, complete=True):
+        #Appends the changed records to the change journal instead of rewriting the whole file,
+        #compacts the journal into a fresh snapshot once it passes JOURNAL_COMPACT_BYTES.
+        #complete=False means ulist only holds the changed records, compaction then reloads the file
+        if not JOURNAL_MODE:
+            return self.save(filename, ulist) if complete else self.compact(filename, None, ulist)
+        with open(journal_name(filename), "ab+") as f:
+            start = f.seek(0, os.SEEK_END)
+            if start:
+                f.seek(start - 1)
+                if f.read(1) != b"\n":
+                    # an earlier append was cut short: drop its partial line instead of extending it
+                    f.seek(0)
+                    start = f.read().rfind(b"\n") + 1
+                    f.truncate(start)
+                    count("torn_lines", journal_name(filename))
+            f.write("".join(i + "," + ",".join(ulist[i]) + "\n" for i in keys).encode())
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+            count("bytes_written", journal_name(filename), size - start)
+        if size >= JOURNAL_COMPACT_BYTES:
+            self.compact(filename, ulist if complete else None)
+        return True
+
+    def journal_tail(self, filename, start):
+        #The records appended to the change journal from byte start on, which has to be where a line begins.
+        #None when it is not, or when the last line is still incomplete
+        try:
+            with open(journal_name(filename), "rb") as f:
+                f.seek(max(start - 1, 0))
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if start:
+            if not data.startswith(b"\n"):
+                return None
+            data = data[1:]
+        if data and not data.endswith(b"\n"):
+            return None
+        count("bytes_read", journal_name(filename), len(data))
+        records = {}
+        for line in data.decode().splitlines():
+            if line:
+                parts = line.split(",")
+                records[parts[0]] = parts[1:]
+        return records
+
+    def compact(self, filename, ulist=None, changes=None):
+        #Folds the change journal back into a fresh snapshot of the data file
+        if ulist is None:
+            ulist = self.load(filename)
+            ulist.update(changes or {})
+        return self.save(filename, ulist)
+
+
+# Data files whose version GymStore.commit() checks for writes by other processes. ids.txt is not
+# among them, IDs are allocated and saved under the data lock
+VERSIONED_FILES = ("members.txt", "classes.txt", "aggregates.txt")
+
+# Data files that get an offset index, rebuilt by every full save
+INDEXED_FILES = ("members.txt",)
+
+
+class MemberIndex:
+    #Sidecar index <file>.idx mapping a record ID to the byte offset and length of its line, so one record
+    #can be read through a memory map without loading the file. Entries are sorted by ID for binary search,
+    #records appended to the file later are added as an unsorted overflow section at the end of the index.
+    #The header keeps the file's size, mtime and a checksum of its last bytes to tell appends from rewrites
+    MAGIC = b"GYMIDX01"
+    HEADER = struct.Struct("<8sQQQI")  # magic, file size, file mtime_ns, sorted entries, tail crc32
+    ENTRY = struct.Struct("<16sQI")    # ID padded with NUL bytes, offset, length
+    TAIL = 64                          # bytes before the indexed end that the tail crc32 covers
+    MAX_OVERFLOW = 4096                # appended entries kept before the index is rebuilt
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_name = filename + ".idx"
+
+    def tail_crc(self, f, size):
+        f.seek(max(0, size - self.TAIL))
+        return zlib.crc32(f.read(min(size, self.TAIL)))
+
+    def scan(self, f, start):
+        #Index entries of the lines from byte start to the end of the file, later lines replace earlier ones
+        entries = {}
+        f.seek(start)
+        offset = start
+        for line in f:
+            record_id = line.split(b",", 1)[0].rstrip(b"\r\n")
+            if record_id and len(record_id) <= 16:
+                entries[record_id] = (offset, len(line))
+            offset += len(line)
+        return entries
+
+    def build(self):
+        #Writes a fresh index of the whole file
+        with open(self.filename, "rb") as f:
+            entries = self.scan(f, 0)
+            stat = os.fstat(f.fileno())
+            crc = self.tail_crc(f, stat.st_size)
+        with open(self.index_name + ".tmp", "wb") as out:
+            out.write(self.HEADER.pack(self.MAGIC, stat.st_size, stat.st_mtime_ns, len(entries), crc))
+            for record_id in sorted(entries):
+                out.write(self.ENTRY.pack(record_id, *entries[record_id]))
+        os.replace(self.index_name + ".tmp", self.index_name)
+
+    def refresh(self):
+        #Makes the index match the file: nothing to do when it is current, appended records are added
+        #to the overflow section in place, anything else means a full rebuild
+        try:
+            stat = os.stat(self.filename)
+            with open(self.index_name, "r+b") as idx:
+                magic, size, mtime, sorted_count, crc = self.HEADER.unpack(idx.read(self.HEADER.size))
+                if magic != self.MAGIC:
+                    raise ValueError("not an index")
+                if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+                    return
+                overflow = (os.fstat(idx.fileno()).st_size - self.HEADER.size) // self.ENTRY.size - sorted_count
+                with open(self.filename, "rb") as f:
+                    if stat.st_size > size and overflow < self.MAX_OVERFLOW and self.tail_crc(f, size) == crc:
+                        entries = self.scan(f, size)
+                        idx.seek(0, os.SEEK_END)
+                        for record_id, (offset, length) in entries.items():
+                            idx.write(self.ENTRY.pack(record_id, offset, length))
+                        idx.seek(0)
+                        idx.write(self.HEADER.pack(self.MAGIC, stat.st_size, stat.st_mtime_ns, sorted_count,
+                                                   self.tail_crc(f, stat.st_size)))
+                        return
+        except (FileNotFoundError, ValueError, struct.error):
+            pass
+        self.build()
+
+    def lookup(self, record_id):
+        #(offset, length) of the record's line, None when the file has no such record
+        self.refresh()
+        key = record_id.encode().ljust(16, b"\0")
+        if len(key) > 16:
+            return None
+        with open(self.index_name, "rb") as idx:
+            if os.fstat(idx.fileno()).st_size == self.HEADER.size:
+                return None
+            with mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sorted_count = self.HEADER.unpack_from(mm, 0)[3]
+                size = self.ENTRY.size
+                start = self.HEADER.size
+                # appended records are newer, so the overflow section is searched first, newest entry first
+                for i in range((len(mm) - start) // size - 1, sorted_count - 1, -1):
+                    if mm[start + i * size:start + i * size + 16] == key:
+                        return self.ENTRY.unpack_from(mm, start + i * size)[1:]
+                lo, hi = 0, sorted_count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if mm[start + mid * size:start + mid * size + 16] < key:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                if lo < sorted_count and mm[start + lo * size:start + lo * size + 16] == key:
+                    return self.ENTRY.unpack_from(mm, start + lo * size)[1:]
+        return None
+
+
+# Data files that get a binary snapshot, rewritten by every full save, see Snapshot
+SNAPSHOT_FILES = ("members.txt", "classes.txt")
+SNAPSHOTS = True
+
+
+class Snapshot:
+    #Binary copy <file>.snap of a CSV data file, so that loading is one read and a few bulk decodes instead of
+    #splitting every line. Every distinct string is stored once in a table (NUL separated UTF-8), records are
+    #uint32 string numbers: one key per record, the offset of each record's fields and the fields themselves.
+    #The header keeps the CSV's size, mtime and a checksum of its last bytes, a snapshot that does not match
+    #the CSV is ignored
+    MAGIC = b"GYMSNAP1"
+    HEADER = struct.Struct("<8sQQIIQ")  # magic, CSV size, CSV mtime_ns, tail crc32, records, string table bytes
+    TAIL = 64
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.snapshot_name = filename + ".snap"
+
+    def fingerprint(self):
+        #(size, mtime_ns, tail crc32) of the CSV file
+        with open(self.filename, "rb") as f:
+            stat = os.fstat(f.fileno())
+            f.seek(max(0, stat.st_size - self.TAIL))
+            return stat.st_size, stat.st_mtime_ns, zlib.crc32(f.read(self.TAIL))
+
+    def write(self, records, fingerprint=None):
+        #Writes the snapshot of records (ID -> fields, as load() returns them) for the CSV as it is now,
+        #or as it was when fingerprint was taken
+        fingerprint = fingerprint or self.fingerprint()
+        table = {}
+        keys = array("I")
+        offsets = array("I", [0])
+        fields = array("I")
+        for key in records:
+            keys.append(table.setdefault(key, len(table)))
+            fields.extend([table.setdefault(value, len(table)) for value in records[key]])
+            offsets.append(len(fields))
+        strings = "\0".join(table).encode()
+        if table and strings.count(b"\0") != len(table) - 1:
+            return False  # a string with a NUL in it cannot go into the table
+        if sys.byteorder == "big":
+            for numbers in (keys, offsets, fields):
+                numbers.byteswap()
+        tmp = f"{self.snapshot_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, *fingerprint, len(keys), len(strings)))
+            f.write(strings)
+            for numbers in (keys, offsets, fields):
+                numbers.tofile(f)
+            count("bytes_written", self.snapshot_name, f.tell())
+        os.replace(tmp, self.snapshot_name)
+        return True
+
+    def load(self):
+        #The records of the snapshot, None when there is none or it does not match the CSV
+        try:
+            with open(self.snapshot_name, "rb") as f:
+                data = f.read()
+            magic, size, mtime, crc, record_count, table_bytes = self.HEADER.unpack_from(data)
+            if magic != self.MAGIC or (size, mtime, crc) != self.fingerprint():
+                return None
+        except (FileNotFoundError, struct.error):
+            return None
+        start = self.HEADER.size
+        table = data[start:start + table_bytes].decode().split("\0")
+        numbers = array("I")
+        numbers.frombytes(data[start + table_bytes:])
+        if sys.byteorder == "big":
+            numbers.byteswap()
+        keys = map(table.__getitem__, numbers[:record_count])
+        offsets = numbers[record_count:2 * record_count + 1]
+        # the records are lists of strings, which cannot form cycles: collecting while millions of them are
+        # created would only scan them over and over
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            fields = list(map(table.__getitem__, numbers[2 * record_count + 1:]))
+            records = dict(zip(keys, map(fields.__getitem__, map(slice, offsets[:-1], offsets[1:]))))
+        finally:
+            if collecting:
+                gc.enable()
+        count("bytes_read", self.snapshot_name, len(data))
+        count("records_parsed", self.snapshot_name, record_count)
+        return records
+
+
+def load_snapshot(filename):
+    #Records of a data file from its snapshot. When the snapshot is missing or stale the CSV is read instead
+    #and the snapshot rebuilt from it in a background thread, None when the CSV does not exist either
+    snapshot = Snapshot(filename)
+    records = snapshot.load()
+    if records is not None:
+        return records
+    try:
+        fingerprint = snapshot.fingerprint()
+        records = read_records(filename, {})
+    except FileNotFoundError:
+        return None
+    if records:
+        threading.Thread(target=snapshot.write, args=(dict(records), fingerprint)).start()
+    return records
+
 
-def class_registrations():
-    # Dictionary to store class information - key is class code
-    classes = {}
-    # Dictionary to store members registered for each class - key is class code
-    class_members = {}
-    # Dictionary to track total revenue for each class - key is class code
-    class_revenue = {}
+def read_record(filename, record_id):
+    #Fields of one record without loading the whole file: the change journal is checked first,
+    #then the offset index points at the record's line in the snapshot. None for an unknown ID.
+    #Holds the data lock, the index may be brought up to date on the way
+    with data_lock():
+        return read_indexed_record(filename, record_id)
 
-    # Read classes.txt  file
+def read_indexed_record(filename, record_id):
+    fields = None
     try:
-        with open('classes.txt', 'r') as class_file:
-            for line in class_file:
-                parts = line.strip().split(',')
-                if len(parts) >= 5:  # Ensure we have enough fields
-                    class_code = parts[0].strip()
-                    class_name = parts[1].strip()
-                    # Cost is now in the fifth position (index 4)
-                    try:
-                        class_cost = float(parts[4].strip())
-                    except ValueError:
-                        print(f"Warning: Invalid cost value for class {class_code}. Using 0.0")
-                        class_cost = 0.0
-
-                    classes[class_code] = {
-                        'name': class_name,
-                        'cost': class_cost
-                    }
-                    class_members[class_code] = []
-                    class_revenue[class_code] = 0.0
+        with open(journal_name(filename), "r") as f:
+            for line in f:
+                if line.startswith(record_id) and line.endswith("\n"):
+                    parts = line.rstrip("\n").split(",")
+                    if parts[0] == record_id:
+                        fields = parts[1:]
     except FileNotFoundError:
-        print("Error: classes.txt file not found.")
-        return
-    except Exception as e:
-        print(f"Error reading classes.txt: {e}")
-        return
-
-    # Read members.txt file
+        pass
+    if fields is not None:
+        return fields
     try:
-        with open('members.txt', 'r') as members_file:
-            for line in members_file:
-                parts = line.strip().split(',')
-                if len(parts) >= 6 and parts[0].startswith('M'):  # Only process regular members
-                    member_id = parts[0].strip()
-                    first_name = parts[1].strip()
-                    last_name = parts[2].strip()
-                    
-                    # Check if there are registered classes (they would be after index 4)
-                    registered_classes = parts[5:] if len(parts) > 5 else []
-                    
-                    for class_code in registered_classes:
-                        class_code = class_code.strip()
-                        # Check if the class code exists
-                        if class_code in classes:
-                            full_name = f"{first_name} {last_name}"
-                            class_members[class_code].append(full_name)
-                            class_revenue[class_code] += classes[class_code]['cost']
+        position = MemberIndex(filename).lookup(record_id)
     except FileNotFoundError:
-        print("Error: members.txt file not found.")
-        return
-    except Exception as e:
-        print(f"Error reading members.txt: {e}")
-        return
+        return None
+    if position is None:
+        return None
+    offset, length = position
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            line = mm[offset:offset + length].decode().rstrip("\r\n")
+    count("records_parsed", filename)
+    return line.split(",")[1:]
 
-    # Generate and print the report
-    print("\n=== CLASS REGISTRATION AND REVENUE REPORT ===\n")
 
-    for class_code in sorted(classes.keys()):
-        class_name = classes[class_code]['name']
-        cost = classes[class_code]['cost']
-        members = class_members[class_code]
-        total_revenue = class_revenue[class_code]
+# Storage backend used by load()/save(), see use_backend()
+BACKEND = TextBackend()
 
-        print(f"Class: {class_name} (Code: {class_code})")
-        print(f"Cost per Member: ${cost:.2f}")
-        print(f"Number of Members: {len(members)}")
-        print(f"Total Revenue: ${total_revenue:.2f}")
-        print("\nRegistered Members:")
 
-        if members:
-            for member in sorted(members):
-                print(f"- {member}")
-        else:
-            print("- No members registered")
+def use_backend(backend):
+    global BACKEND
+    BACKEND = backend
 
-        print("\n" + "-" * 50 + "\n")
+@timed("load")
+def load(filename):
+    #Loads the records of a data file as a dict of ID -> list of fields
+    return BACKEND.load(filename)
 
-    # Print summary of all classes
-    total_all_revenue = sum(class_revenue.values())
-    total_all_members = sum(len(members) for members in class_members.values())
+@timed("save")
+def save(filename, ulist):
+    #Replaces the records of a data file with the given dict of ID -> list of fields
+    REPORT_CACHE.forget()
+    return BACKEND.save(filename, ulist)
+
+@timed("journal")
+def journal(filename, ulist, keys, complete=True):
+    #Writes only the records with the given keys, complete=False when ulist holds nothing but those records
+    REPORT_CACHE.forget()
+    return BACKEND.journal(filename, ulist, keys, complete)
+
+def compact(filename, ulist=None):
+    return BACKEND.compact(filename, ulist)
+
+MEMBERSHIP_FEES = {
+    "Platinum": 10000,
+    "Diamond": 7500,
+    "Gold": 4000,
+    "Standard": 2000
+}
+
+
+def pad(fields, size):
+    #Strips the first size fields of a record and fills missing ones with None,
+    #so a short line can be told apart from one with empty fields
+    return [f.strip() for f in fields[:size]] + [None] * (size - len(fields[:size]))
+
+def unpad(fields):
+    #Drops the trailing None fields added by pad() so short records are saved the way they were read.
+    #A None before a field that was set later (a session given a capacity but no instructor) is saved empty
+    fields = list(fields)
+    while fields and fields[-1] is None:
+        fields.pop()
+    return ["" if field is None else field for field in fields]
+
+def parse_capacity(capacity):
+    #Places in a session, None (no limit) for an empty or invalid capacity
+    if capacity is None or not capacity.strip().isdigit():
+        return None
+    return int(capacity)
+
+def parse_cost(cost):
+    #Converts a class cost to a float, invalid costs are treated as 0.0
+    if cost is None:
+        return None
+    try:
+        return float(cost)
+    except ValueError:
+        return 0.0
+
+
+# Member and instructor IDs are a prefix plus a sequential number, padded to at least ID_WIDTH digits.
+# The next free number of every prefix is kept in ids.txt next to members.txt
+ID_WIDTH = 4
+ID_PREFIXES = ("M", "I")
+
+
+def format_id(prefix, number, width=ID_WIDTH):
+    return prefix + str(number).zfill(width)
+
+def id_number(record_id):
+    #Numeric part of an ID such as M1234, None when the ID is not a prefix followed by digits
+    digits = record_id[1:]
+    return int(digits) if digits.isdigit() else None
+
+
+class IdAllocator:
+    #Hands out unique IDs in constant time from a per-prefix high-water mark instead of retrying random numbers
+    def __init__(self, marks, width=ID_WIDTH):
+        self.marks = marks  # prefix -> next unused number
+        self.width = width
+        self.changed = False
+
+    @classmethod
+    def load(cls, existing_ids, width=ID_WIDTH):
+        #Reads the marks from ids.txt, a prefix missing there is seeded once from the highest existing ID
+        marks = {}
+        for prefix, fields in load("ids.txt").items():
+            if fields and fields[0].isdigit():
+                marks[prefix] = int(fields[0])
+        missing = [prefix for prefix in ID_PREFIXES if prefix not in marks]
+        if missing:
+            for prefix in missing:
+                marks[prefix] = 10 ** (width - 1)
+            for record_id in existing_ids:
+                number = id_number(record_id)
+                if record_id[:1] in missing and number is not None and number >= marks[record_id[:1]]:
+                    marks[record_id[:1]] = number + 1
+        allocator = cls(marks, width)
+        allocator.changed = bool(missing)
+        return allocator
+
+    def allocate(self, prefix, taken=()):
+        #Returns the next free ID, IDs already in taken (e.g. added by hand) are skipped
+        while True:
+            number = self.marks.get(prefix, 10 ** (self.width - 1))
+            self.marks[prefix] = number + 1
+            self.changed = True
+            new_id = format_id(prefix, number, self.width)
+            if new_id not in taken:
+                return new_id
+
+    def reserve(self, prefix, count, taken=()):
+        #Reserves a block of count IDs at once, for imports
+        return [self.allocate(prefix, taken) for _ in range(count)]
+
+    def save(self):
+        if self.changed:
+            save("ids.txt", {prefix: [str(number)] for prefix, number in self.marks.items()})
+            self.changed = False
+
+
+class CodeTable:
+    #Interns strings that repeat on many records (class codes, membership types) as small integer codes
+    __slots__ = ("names", "codes")
 
-    print("=== SUMMARY ===")
-    print(f"Total Number of Classes: {len(classes)}")
-    print(f"Total Number of Registrations: {total_all_members}")
-    print(f"Total Revenue: ${total_all_revenue:.2f}")
+    def __init__(self):
+        self.names = []  # code -> string
+        self.codes = {}  # string -> code
 
-def generate_client_report():
-    membership_fees = {
-        "Platinum": 10000,
-        "Diamond": 7500,
-        "Gold": 4000,
-        "Standard": 2000
-    }
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(sys.intern(name))
+        return code
+
+    def encode(self, names):
+        #Array of codes, None for no names so that records without classes carry no array at all
+        return array("I", [self.code(name) for name in names]) if names else None
 
-    # Dictionary to store class information - key is class ID
-    classes = {}
+    def decode(self, codes):
+        names = self.names
+        return [names[code] for code in codes] if codes else []
 
-    # Dictionary to store client information - key is member ID
-    clients = {}
 
-    try:
-        with open('classes.txt', 'r') as class_file:
-            for line in class_file:
-                parts = line.strip().split(',')
-                if len(parts) >= 5:
-                    class_id = parts[0].strip()
-                    class_name = parts[1].strip()
-                    # Cost is now in the fifth position (index 4)
-                    try:
-                        class_cost = float(parts[4].strip())
-                    except ValueError:
-                        print(f"Warning: Invalid cost value for class {class_id}. Using 0.0")
-                        class_cost = 0.0
-
-                    classes[class_id] = {
-                        'name': class_name,
-                        'cost': class_cost
-                    }
-    except FileNotFoundError:
-        print("Error: classes.txt file not found.")
-        return
-    except Exception as e:
-        print(f"Error reading classes.txt: {e}")
-        return
+CLASS_CODES = CodeTable()
+TIER_CODES = CodeTable()
 
-    try:
-        with open('members.txt', 'r') as members_file:
-            for line in members_file:
-                parts = line.strip().split(',')
-                if len(parts) >= 5 and parts[0].startswith('M'):  # Only process regular members
-                    member_id = parts[0].strip()
-                    first_name = parts[1].strip()
-                    last_name = parts[2].strip()
-                    membership_type = parts[4].strip()
-                    
-                    # Get registered classes (if any) - they would be after index 4
-                    registered_classes = parts[5:] if len(parts) > 5 else []
-
-                    # Initialize member record
-                    clients[member_id] = {
-                        'first_name': first_name,
-                        'last_name': last_name,
-                        'membership_type': membership_type,
-                        'classes': [],
-                        'total_fee': 0.0
-                    }
-                    
-                    # Add classes to member's record
-                    for class_id in registered_classes:
-                        class_id = class_id.strip()
-                        if class_id in classes:
-                            clients[member_id]['classes'].append({
-                                'id': class_id,
-                                'name': classes[class_id]['name'],
-                                'cost': classes[class_id]['cost']
-                            })
-    except FileNotFoundError:
-        print("Error: members.txt file not found.")
-        return
-    except Exception as e:
-        print(f"Error reading members.txt: {e}")
-        return
 
-    # Calculate total monthly fee for each client
-    for member_id, client_info in clients.items():
-        # Start with the base membership fee
-        membership_type = client_info['membership_type']
-        if membership_type in membership_fees:
-            base_fee = membership_fees[membership_type]
-        else:
-            base_fee = 0.0
-            print(f"Warning: Unknown membership type '{membership_type}' for client {member_id}")
+# The records below use __slots__ and keep the class codes and the membership type as integer codes,
+# registrations as an array of class codes. Retained memory per member measured with
+# "gym_bench.py memory" on 100,000 generated members (2 / 5 classes per member on average):
+#   dict of lists returned by load()       530 / 715 bytes
+#   plain attribute records                636 bytes (2 classes)
+#   these records                          415 / 436 bytes
+#   whole GymStore including its indexes   480 / 525 bytes
+
+class Member:
+    #A regular member, stored in members.txt as: M0000,first name,last name,contact,membership type,classes...
+    __slots__ = ("member_id", "first_name", "last_name", "contact_number", "tier", "codes")
+
+    def __init__(self, member_id, first_name, last_name, contact_number, membership_type, classes=None):
+        self.member_id = member_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.contact_number = contact_number
+        self.membership_type = membership_type
+        self.codes = CLASS_CODES.encode(classes)
+
+    @classmethod
+    def from_fields(cls, member_id, fields):
+        return cls(member_id, *pad(fields, 4), [c.strip() for c in fields[4:]])
+
+    @property
+    def membership_type(self):
+        return TIER_CODES.names[self.tier] if self.tier >= 0 else None
+
+    @membership_type.setter
+    def membership_type(self, membership_type):
+        self.tier = TIER_CODES.code(membership_type) if membership_type is not None else -1
+
+    @property
+    def classes(self):
+        #Registered class codes as a new list, use add_class() to register
+        return CLASS_CODES.decode(self.codes)
+
+    def add_class(self, class_id):
+        if self.codes is None:
+            self.codes = array("I")
+        self.codes.append(CLASS_CODES.code(class_id))
+
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+    def fields(self):
+        return unpad([self.first_name, self.last_name, self.contact_number, self.membership_type]) + self.classes
+
+
+class Instructor:
+    #An instructor, stored in members.txt as: I0000,first name,last name,contact,TRN,date of birth
+    __slots__ = ("instructor_id", "first_name", "last_name", "contact_number", "trn", "dob", "codes")
+
+    def __init__(self, instructor_id, first_name, last_name, contact_number, trn, dob, classes=None):
+        self.instructor_id = instructor_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.contact_number = contact_number
+        self.trn = trn
+        self.dob = dob
+        self.codes = CLASS_CODES.encode(classes)
 
-        # Add the cost of all classes
-        class_fees = sum(class_info['cost'] for class_info in client_info['classes'])
+    @classmethod
+    def from_fields(cls, instructor_id, fields):
+        return cls(instructor_id, *pad(fields, 5), [c.strip() for c in fields[5:]])
 
-        # Calculate total fee
-        total_fee = base_fee + class_fees
-        clients[member_id]['total_fee'] = total_fee
+    classes = Member.classes
+    add_class = Member.add_class
 
-    # Generate and print the report
-    print("\n=== GYM CLIENT MONTHLY FEE REPORT ===\n")
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+    def fields(self):
+        return unpad([self.first_name, self.last_name, self.contact_number, self.trn, self.dob]) + self.classes
 
-    for member_id in sorted(clients.keys()):
-        client = clients[member_id]
 
-        print(f"Client ID: {member_id}")
-        print(f"Name: {client['first_name']} {client['last_name']}")
-        print(f"Membership Type: {client['membership_type']}")
+class Record:
+    #Any other line of members.txt, kept as is so that saving does not lose it
+    __slots__ = ("record_id", "classes")
 
-        if client['membership_type'] in membership_fees:
-            print(f"Base Membership Fee: ${membership_fees[client['membership_type']]:.2f}")
-        else:
-            print(f"Base Membership Fee: Unknown (membership type not found)")
+    def __init__(self, record_id, fields):
+        self.record_id = record_id
+        # the raw fields, a check-in appends the class to the end like for any other record
+        self.classes = fields
 
-        print("\nRegistered Classes:")
-        if client['classes']:
-            class_total = 0.0
-            for class_info in client['classes']:
-                print(f"- {class_info['name']} (ID: {class_info['id']}) - ${class_info['cost']:.2f}")
-                class_total += class_info['cost']
-            print(f"\nTotal Class Fees: ${class_total:.2f}")
-        else:
-            print("- No additional classes registered")
-            print("\nTotal Class Fees: $0.00")
+    def add_class(self, class_id):
+        self.classes.append(class_id)
 
-        print(f"\nTOTAL MONTHLY FEE: ${client['total_fee']:.2f}")
-        print("\n" + "-" * 50 + "\n")
+    def fields(self):
+        return self.classes
 
-    # Print summary
-    total_clients = len(clients)
-    total_revenue = sum(client['total_fee'] for client in clients.values())
 
-    print("=== SUMMARY ===")
-    print(f"Total Number of Clients: {total_clients}")
-    print(f"Total Monthly Revenue: ${total_revenue:.2f}")
+class GymClass:
+    #A session, stored in classes.txt as: C0000,name,day,time,cost,instructor[,capacity]
+    __slots__ = ("class_id", "name", "day", "time", "cost_text", "cost", "instructor", "capacity_text", "capacity",
+                 "extra")
+
+    def __init__(self, class_id, name, day, time, cost, instructor, capacity=None, extra=None):
+        self.class_id = sys.intern(class_id)
+        self.name = name
+        self.day = day
+        self.time = time
+        self.cost_text = cost
+        self.cost = parse_cost(cost)
+        self.instructor = instructor
+        self.capacity_text = capacity
+        self.capacity = parse_capacity(capacity)
+        self.extra = extra if extra is not None else []
+
+    @classmethod
+    def from_fields(cls, class_id, fields):
+        return cls(class_id, *pad(fields, 6), fields[6:])
+
+    def scheduled(self):
+        #Only sessions with at least a name, day, time and cost show up in the reports
+        return self.cost_text is not None
 
-def checkin():
-    #Checks in members to the gym, displays data about additional classes and allows members to register
-    members = load("members.txt")
-    classes = load("classes.txt")
+    def valid_cost(self):
+        try:
+            float(self.cost_text)
+            return True
+        except ValueError:
+            return False
+
+    def fields(self):
+        return unpad([self.name, self.day, self.time, self.cost_text, self.instructor, self.capacity_text]) + self.extra
+
+
+class FieldsView:
+    #Presents a table of records as the {id: [fields]} dict that save() and journal() write
+    def __init__(self, table):
+        self.table = table
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __getitem__(self, key):
+        return self.table[key].fields()
+
+
+class Aggregates:
+    #Running totals kept in aggregates.txt and adjusted on every write, so the summary numbers come back
+    #without scanning the members: registrations and revenue per scheduled class, members and monthly
+    #fees per membership type, and the grand totals
+    def __init__(self):
+        self.classes = {}            # scheduled class code -> [registrations, revenue]
+        self.tiers = {}              # membership type -> [members, monthly fees]
+        self.total = [0, 0.0, 0, 0]  # registrations, class revenue, members, membership fees
+        self.changed = {}
+
+    @classmethod
+    def build(cls, store):
+        #Recomputes every total from the records in the store
+        totals = cls()
+        for class_id, gym_class in store.scheduled_classes().items():
+            totals.set_class(class_id, len(store.class_members.get(class_id, ())), gym_class.cost)
+        for membership_type, member_ids in store.by_type.items():
+            totals.set_tier(membership_type, len(member_ids))
+        return totals
+
+    @classmethod
+    def load(cls):
+        #Reads aggregates.txt, None when the totals were never stored
+        rows = load("aggregates.txt")
+        if "total" not in rows:
+            return None
+        totals = cls()
+        for key, fields in rows.items():
+            if key.startswith("class:"):
+                totals.classes[key[6:]] = [int(fields[0]), float(fields[1])]
+            elif key.startswith("type:"):
+                totals.tiers[key[5:]] = [int(fields[0]), float(fields[1])]
+        registrations, revenue, members, fees = rows["total"]
+        totals.total = [int(registrations), float(revenue), int(members), float(fees)]
+        return totals
+
+    def set_class(self, class_id, registrations, cost):
+        #Replaces the row of a class, cost is None when the code is not a scheduled class
+        old = self.classes.pop(class_id, None)
+        if old:
+            self.total[0] -= old[0]
+            self.total[1] -= old[1]
+        if cost is not None:
+            row = self.classes[class_id] = [registrations, cost * registrations]
+            self.total[0] += row[0]
+            self.total[1] += row[1]
+        self.changed["class:" + class_id] = old is not None and cost is None
+
+    def set_tier(self, membership_type, members):
+        old = self.tiers.get(membership_type, [0, 0])
+        row = self.tiers[membership_type] = [members, MEMBERSHIP_FEES.get(membership_type, 0) * members]
+        self.total[2] += row[0] - old[0]
+        self.total[3] += row[1] - old[1]
+        self.changed["type:" + membership_type] = False
+
+    def class_revenue(self):
+        return {class_id: tuple(row) for class_id, row in self.classes.items()}
+
+    def rows(self):
+        rows = {"class:" + class_id: [str(n) for n in row] for class_id, row in self.classes.items()}
+        rows.update({"type:" + t: [str(n) for n in row] for t, row in self.tiers.items()})
+        rows["total"] = [str(n) for n in self.total]
+        return rows
+
+    def commit(self, full=False):
+        #Journals the changed rows, a removed row needs a fresh snapshot
+        if self.changed:
+            rows = self.rows()
+            if full or any(self.changed.values()):
+                save("aggregates.txt", rows)
+            else:
+                journal("aggregates.txt", rows, list(self.changed) + ["total"])
+            self.changed.clear()
+
+    def drift(self, other):
+        #Lines describing every number that differs from the totals in other
+        lines = []
+        for label, mine, theirs in (("class", self.classes, other.classes), ("type", self.tiers, other.tiers)):
+            for key in sorted(set(mine) | set(theirs)):
+                a, b = mine.get(key, [0, 0]), theirs.get(key, [0, 0])
+                if a[0] != b[0] or abs(a[1] - b[1]) >= 0.005:
+                    lines.append(f"{label} {key}: stored {a[0]} / ${a[1]:.2f}, actual {b[0]} / ${b[1]:.2f}")
+        if [self.total[0], self.total[2]] != [other.total[0], other.total[2]] or \
+                abs(self.total[1] - other.total[1]) >= 0.005 or abs(self.total[3] - other.total[3]) >= 0.005:
+            lines.append(f"totals: stored {self.total}, actual {other.total}")
+        return lines
+
+
+# Sessions are scheduled by a free text Day field (Monday, Mon & Wed, Mon-Fri, Daily, Weekends ...) and a
+# Time field holding a slot such as Morning/Evening or a clock time such as 6pm or 18:00
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+DAY_GROUPS = {"daily": range(7), "everyday": range(7), "weekdays": range(5), "weekends": range(5, 7), "weekend": range(5, 7)}
+TIME_SLOTS = {"morning": 12, "afternoon": 17, "evening": 24, "night": 24}  # slot -> hour at which it is over
+
+
+def weekday_number(word):
+    #0 for Monday through 6 for Sunday, from the full name or any abbreviation of at least three letters
+    word = word.lower()
+    for number, name in enumerate(WEEKDAYS):
+        if len(word) >= 3 and name.lower().startswith(word):
+            return number
+    return None
+
+def session_days(day):
+    #Weekday numbers a Day field names, an empty set when it names none
+    if not day:
+        return set()
+    days = set()
+    for first, last in re.findall(r"([A-Za-z]+)\s*-\s*([A-Za-z]+)", day):
+        start, end = weekday_number(first), weekday_number(last)
+        if start is not None and end is not None:
+            days.update(range(start, end + 1) if start <= end else list(range(start, 7)) + list(range(end + 1)))
+    for word in re.findall(r"[A-Za-z]+", day):
+        if word.lower() in DAY_GROUPS:
+            days.update(DAY_GROUPS[word.lower()])
+        elif weekday_number(word) is not None:
+            days.add(weekday_number(word))
+    return days
+
+def session_end_hour(time):
+    #Hour of the day after which a session no longer counts as upcoming, None when the Time field does not say
+    if not time:
+        return None
+    text = time.strip().lower()
+    for slot, hour in TIME_SLOTS.items():
+        if slot in text:
+            return hour
+    clock = re.match(r"(\d{1,2})(?::(\d{2}))?\s*([ap]m)?", text)
+    if clock:
+        hour = int(clock.group(1)) % 12 + (12 if clock.group(3) == "pm" else 0) if clock.group(3) else int(clock.group(1))
+        if hour < 24:
+            return hour + 1
+    return None
+
+
+class ScheduleIndex:
+    #Sessions by weekday and by instructor, kept up to date by GymStore.set_class()/update_class(), so that
+    #check-in can list today's upcoming sessions and the schedule report can filter without scanning every class
+    def __init__(self):
+        self.days = {number: set() for number in range(7)}  # weekday number -> class codes held that day
+        self.instructors = {}  # instructor name in lower case -> class codes
+        self.entries = {}      # class code -> (weekday numbers, instructor key, end hour, position in classes.txt)
+
+    @classmethod
+    def build(cls, classes):
+        index = cls()
+        for gym_class in classes.values():
+            index.update(gym_class)
+        return index
+
+    def remove(self, class_id):
+        days, instructor, _, _ = self.entries.pop(class_id)
+        for number in days:
+            self.days[number].discard(class_id)
+        self.instructors[instructor].discard(class_id)
+
+    def update(self, gym_class):
+        #Adds a session or moves it to its current day, time and instructor
+        position = len(self.entries)
+        if gym_class.class_id in self.entries:
+            position = self.entries[gym_class.class_id][3]
+            self.remove(gym_class.class_id)
+        days = session_days(gym_class.day)
+        instructor = (gym_class.instructor or "").strip().lower()
+        self.entries[gym_class.class_id] = (days, instructor, session_end_hour(gym_class.time), position)
+        for number in days:
+            self.days[number].add(gym_class.class_id)
+        self.instructors.setdefault(instructor, set()).add(gym_class.class_id)
+
+    def ordered(self, class_ids):
+        #Class codes in classes.txt order
+        return sorted(class_ids, key=lambda class_id: self.entries[class_id][3])
+
+    def find(self, day=None, instructor=None):
+        #Codes of the sessions held on the given day (a weekday name) and by the given instructor, in file order
+        found = None
+        if day is not None:
+            number = weekday_number(day)
+            found = set(self.days[number]) if number is not None else set()
+        if instructor is not None:
+            taught = self.instructors.get(instructor.strip().lower(), set())
+            found = set(taught) if found is None else found & taught
+        return self.ordered(self.entries if found is None else found)
+
+    def upcoming(self, when):
+        #Codes of the sessions still ahead on the day of when; a session whose time cannot be read is included
+        return self.ordered(class_id for class_id in self.days[when.weekday()]
+                            if self.entries[class_id][2] is None or when.hour < self.entries[class_id][2])
+
+
+# Most matches check-in lists for a name or phone number search
+SEARCH_LIMIT = 10
+
+
+class SearchIndex:
+    #People by first name, last name and contact number for prefix searches. Every distinct value, case folded,
+    #is kept once in a sorted list, so the values starting with a prefix are found with one bisect and lie next
+    #to each other; each value maps to the IDs of the people that have it. Built by GymStore.search() the first
+    #time it is needed and kept up to date by GymStore.index_person()
+    def __init__(self):
+        self.keys = []    # distinct case folded values, sorted
+        self.people = {}  # value -> IDs of the people with that value, in file order
+
+    @classmethod
+    def build(cls, people):
+        index = cls()
+        postings = index.people
+        for person_id, person in people.items():
+            if isinstance(person, (Member, Instructor)):
+                for value in (person.first_name, person.last_name, person.contact_number):
+                    value = value.strip().casefold() if value else None
+                    if value:
+                        postings.setdefault(value, []).append(person_id)
+        index.keys = sorted(postings)
+        return index
+
+    @staticmethod
+    def values(person):
+        #The searchable values of a member or instructor, nothing for other records
+        if not isinstance(person, (Member, Instructor)):
+            return set()
+        return {value.strip().casefold() for value in (person.first_name, person.last_name, person.contact_number)
+                if value and value.strip()}
+
+    def add(self, person_id, person):
+        for value in self.values(person):
+            ids = self.people.get(value)
+            if ids is None:
+                ids = self.people[value] = []
+                bisect.insort(self.keys, value)
+            ids.append(person_id)
+
+    def matching(self, prefix):
+        #IDs of the people with a value starting with prefix (case folded), people whose value is the prefix
+        #itself first, then by value in alphabetical order. An ID comes once for every value of it that matches
+        position = bisect.bisect_left(self.keys, prefix)
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            yield from self.people[self.keys[position]]
+            position += 1
+
+
+def person_from_fields(person_id, fields):
+    #The typed record for a members.txt line, chosen by the prefix of its ID
+    if person_id.startswith("M"):
+        return Member.from_fields(person_id, fields)
+    elif person_id.startswith("I"):
+        return Instructor.from_fields(person_id, fields)
+    return Record(person_id, fields)
+
+
+class GymStore:
+    #Parses members.txt and classes.txt once into typed records and keeps the indexes that every
+    #report and menu action queries. Changed records are written back through the change journal by commit()
+    def __init__(self):
+        self.people = {}         # every members.txt record by ID, in file order
+        self.members = {}        # regular members by ID
+        self.instructors = {}    # instructors by ID
+        self.classes = {}        # sessions by class code, in file order
+        self.schedule = ScheduleIndex()
+        self.by_type = {}        # membership type -> IDs of members with that type
+        self.class_members = {}  # class code -> set of the IDs of members registered for it
+        self.changed = {"members.txt": {}, "classes.txt": {}}
+        self.ids = None          # IdAllocator, loaded on first use
+        self.totals = None       # Aggregates, loaded on first use
+        self.version = None      # BACKEND.version() of the data this store was loaded from
+        self.log = []            # (method, args) of every mutation since the last commit, see replay()
+        self.search_index = None # SearchIndex, built on the first search
+        self.attendance = []     # (member ID, class ID, time) of check-ins logged once commit() has written them
+        self.refused = []        # (member ID, class ID, reason) of the registrations the last commit() dropped
+
+    @classmethod
+    @timed("store_load")
+    def load(cls):
+        store = cls()
+        with data_lock(shared=True):
+            store.version = BACKEND.version(VERSIONED_FILES)
+            people = load("members.txt")
+            classes = load("classes.txt")
+        for person_id, fields in people.items():
+            store.index_person(person_id, person_from_fields(person_id, fields))
+        for class_id, fields in classes.items():
+            store.classes[class_id] = GymClass.from_fields(class_id, fields)
+        store.schedule = ScheduleIndex.build(store.classes)
+        return store
+
+    def index_person(self, person_id, person):
+        self.people[person_id] = person
+        if isinstance(person, Member):
+            self.members[person_id] = person
+            if person.membership_type is not None:
+                self.by_type.setdefault(person.membership_type, []).append(person_id)
+            for class_id in person.classes:
+                self.class_members.setdefault(class_id, set()).add(person_id)
+        elif isinstance(person, Instructor):
+            self.instructors[person_id] = person
+        if self.search_index is not None:
+            self.search_index.add(person_id, person)
+
+    def touch(self, filename, key):
+        self.changed[filename][key] = True
+
+    # Queries
+
+    def scheduled_classes(self):
+        return {class_id: c for class_id, c in self.classes.items() if c.scheduled()}
+
+    def class_roster(self, class_id):
+        #Members registered for a class
+        return [self.members[m] for m in self.class_members.get(class_id, ())]
+
+    def member_classes(self, member_id):
+        #Scheduled classes a member is registered for, in registration order. A class repeated on an
+        #old member line is a registration made before duplicates were refused and is only counted once
+        return [self.classes[c] for c in dict.fromkeys(self.people[member_id].classes)
+                if c in self.classes and self.classes[c].scheduled()]
+
+    def search(self, query, among=None, limit=SEARCH_LIMIT):
+        #IDs of up to limit people (of among, by default everyone) with a first name, last name or contact number
+        #starting with each word of query, ignoring case. The longest word is looked up in the search index,
+        #which ranks exact values first; the other words are checked on the people it finds
+        if self.search_index is None:
+            self.search_index = SearchIndex.build(self.people)
+        among = self.people if among is None else among
+        words = query.casefold().split()
+        if not words:
+            return []
+        words.sort(key=len)
+        lookup = words.pop()
+        found = {}
+        for person_id in self.search_index.matching(lookup):
+            if person_id in found or person_id not in among:
+                continue
+            values = SearchIndex.values(among[person_id])
+            if all(any(value.startswith(word) for value in values) for word in words):
+                found[person_id] = True
+                if len(found) == limit:
+                    break
+        return list(found)
+
+    def registered(self, member_id, class_id):
+        if member_id in self.members:
+            return member_id in self.class_members.get(class_id, ())
+        return class_id in self.people[member_id].classes
+
+    def registration_error(self, member_id, class_id):
+        #Why the member cannot check in for the class, None when they can. A member already registered for it
+        #always can, only a new registration needs a free place
+        if self.registered(member_id, class_id):
+            return None
+        capacity = self.classes[class_id].capacity
+        if capacity is not None and len(self.class_members.get(class_id, ())) >= capacity:
+            return f"Class {class_id} is full ({capacity} places)"
+        return None
+
+    def billed_members(self):
+        #Members that have a membership type, the ones that receive a monthly bill
+        return {m: self.members[m] for ids in self.by_type.values() for m in ids}
+
+    def aggregates(self):
+        #Running totals stored with the data, built from the records the first time they are needed
+        if self.totals is None:
+            self.totals = Aggregates.load()
+            if self.totals is None:
+                self.totals = Aggregates.build(self)
+                with data_lock():
+                    current = self.version == BACKEND.version(VERSIONED_FILES)
+                    self.totals.commit(full=True)
+                    if current:
+                        self.version = BACKEND.version(VERSIONED_FILES)
+        return self.totals
+
+    def refresh_class(self, class_id):
+        gym_class = self.classes.get(class_id)
+        cost = gym_class.cost if gym_class is not None and gym_class.scheduled() else None
+        self.aggregates().set_class(class_id, len(self.class_members.get(class_id, ())), cost)
+
+    # Mutations
+
+    def allocator(self):
+        #Rereads ids.txt, called with the data lock held so the marks are those of the last allocation anywhere
+        self.ids = IdAllocator.load(self.people)
+        return self.ids
+
+    @timed("new_id")
+    def new_id(self, prefix):
+        #IDs are saved as soon as they are handed out, so concurrent terminals never give out the same one
+        with data_lock():
+            new_id = self.allocator().allocate(prefix, self.people)
+            self.ids.save()
+        return new_id
+
+    def reserve_ids(self, prefix, count):
+        with data_lock():
+            new_ids = self.allocator().reserve(prefix, count, self.people)
+            self.ids.save()
+        return new_ids
+
+    def register(self, member_id, class_id):
+        #Adds the class to the member's record, a registration that already exists is left alone.
+        #Returns whether anything changed; callers check registration_error() first to tell the user why not
+        if self.registered(member_id, class_id):
+            return False
+        self.log.append(("register", (member_id, class_id)))
+        self.aggregates()
+        self.people[member_id].add_class(class_id)
+        if member_id in self.members:
+            self.class_members.setdefault(class_id, set()).add(member_id)
+            self.refresh_class(class_id)
+        self.touch("members.txt", member_id)
+        return True
+
+    def attend(self, member_id, class_id, when=None):
+        #Queues a check-in for the attendance log, written by commit() after the registration is durable
+        when = when or datetime.now()
+        self.log.append(("attend", (member_id, class_id, when)))
+        self.attendance.append((member_id, class_id, when))
+
+    def add_member(self, member):
+        self.log.append(("add_member", (member,)))
+        self.aggregates()
+        self.index_person(member.member_id, member)
+        if member.membership_type is not None:
+            self.totals.set_tier(member.membership_type, len(self.by_type[member.membership_type]))
+        self.touch("members.txt", member.member_id)
+
+    def add_instructor(self, instructor):
+        self.log.append(("add_instructor", (instructor,)))
+        self.index_person(instructor.instructor_id, instructor)
+        self.touch("members.txt", instructor.instructor_id)
+
+    def set_class(self, gym_class):
+        self.log.append(("set_class", (gym_class,)))
+        self.aggregates()
+        self.classes[gym_class.class_id] = gym_class
+        self.schedule.update(gym_class)
+        self.refresh_class(gym_class.class_id)
+        self.touch("classes.txt", gym_class.class_id)
+
+    def update_class(self, class_id, name=None, day=None, time=None, cost=None, instructor=None, capacity=None):
+        #Changes the given fields of a session, fields left as None keep their current value
+        self.log.append(("update_class", (class_id, name, day, time, cost, instructor, capacity)))
+        gym_class = self.classes[class_id]
+        if name:
+            gym_class.name = name
+        if day:
+            gym_class.day = day
+        if time:
+            gym_class.time = time
+        if cost:
+            self.aggregates()
+            gym_class.cost_text = cost
+            gym_class.cost = parse_cost(cost)
+            self.refresh_class(class_id)
+        if instructor:
+            gym_class.instructor = instructor
+        if capacity:
+            gym_class.capacity_text = capacity
+            gym_class.capacity = parse_capacity(capacity)
+        self.schedule.update(gym_class)
+        self.touch("classes.txt", class_id)
+
+    @timed("store_commit")
+    def commit(self, full=False):
+        #Writes every record changed since the last commit to the change journal,
+        #or with full=True rewrites the changed files as fresh snapshots (used by bulk imports).
+        #Runs under the data lock; if another process wrote since this store was loaded, its changes
+        #are replayed over the current data first so neither side's updates are lost.
+        #Registrations the other process made impossible are dropped and listed in refused
+        self.refused = []
+        with data_lock():
+            if self.version != BACKEND.version(VERSIONED_FILES):
+                count("commit_conflicts", "store")
+                self.replay()
+            if self.totals is not None:
+                self.totals.commit(full)
+            for filename, table in (("members.txt", self.people), ("classes.txt", self.classes)):
+                keys = self.changed[filename]
+                if keys:
+                    if full:
+                        save(filename, FieldsView(table))
+                    else:
+                        journal(filename, FieldsView(table), list(keys))
+                    keys.clear()
+            self.version = BACKEND.version(VERSIONED_FILES)
+        self.log.clear()
+        if self.attendance:
+            log = AttendanceLog()
+            for member_id, class_id, when in self.attendance:
+                log.record(member_id, class_id, when)
+            self.attendance.clear()
+        return True
+
+    def discard(self):
+        #Drops the changes not committed yet; the data is reloaded by the next current()
+        self.log.clear()
+        self.attendance.clear()
+        for keys in self.changed.values():
+            keys.clear()
+        self.version = None
+
+    def current(self):
+        #This store while the data files are as it last loaded or committed them, or while it has changes of
+        #its own to commit; otherwise the store with another process's writes, read from the end of the change
+        #journals when that is all they did (see catch_up()) and freshly loaded when not
+        if self.log or self.version == BACKEND.version(VERSIONED_FILES):
+            count("store_reuse", "kept")
+            return self
+        if self.catch_up():
+            count("store_reuse", "caught up")
+            return self
+        count("store_reuse", "reloaded")
+        return GymStore.load()
+
+    def catch_up(self):
+        #Applies the records other processes appended to the journals of members.txt and classes.txt since this
+        #store read them, the running totals are reread when next needed. Returns False and leaves the store as
+        #it was when that is not enough: a file was rewritten, or a person changed kind, membership type,
+        #name or contact number, which the indexes by type and by name would have to follow
+        if not isinstance(BACKEND, TextBackend) or self.version is None:
+            return False
+        with data_lock(shared=True):
+            version = BACKEND.version(VERSIONED_FILES)
+            tails = {}
+            for filename, (main, journal), (new_main, new_journal) in zip(VERSIONED_FILES, self.version, version):
+                if filename == "aggregates.txt" or journal == new_journal:
+                    continue
+                if main != new_main or new_journal is None:
+                    return False
+                tails[filename] = BACKEND.journal_tail(filename, journal[0] if journal else 0)
+                if tails[filename] is None:
+                    return False
+        people = {person_id: person_from_fields(person_id, fields)
+                  for person_id, fields in tails.get("members.txt", {}).items()}
+        for person_id, person in people.items():
+            old = self.people.get(person_id)
+            if old is not None and (type(old) is not type(person)
+                                    or getattr(old, "membership_type", None) != getattr(person, "membership_type", None)
+                                    or SearchIndex.values(old) != SearchIndex.values(person)):
+                return False
+        for person_id, person in people.items():
+            old = self.people.get(person_id)
+            if old is None:
+                self.index_person(person_id, person)
+                continue
+            self.people[person_id] = person
+            if isinstance(person, Member):
+                self.members[person_id] = person
+                for class_id in old.classes:
+                    self.class_members.get(class_id, set()).discard(person_id)
+                for class_id in person.classes:
+                    self.class_members.setdefault(class_id, set()).add(person_id)
+            elif isinstance(person, Instructor):
+                self.instructors[person_id] = person
+        for class_id, fields in tails.get("classes.txt", {}).items():
+            self.classes[class_id] = GymClass.from_fields(class_id, fields)
+            self.schedule.update(self.classes[class_id])
+        self.ids = None
+        self.totals = None
+        self.version = version
+        return True
+
+    def replay(self):
+        #Reloads the data and reapplies the mutations logged since the last commit on top of it. A registration
+        #is checked again first, if the class filled up meanwhile it is refused together with its check-in
+        fresh = GymStore.load()
+        refused = set()
+        for method, args in self.log:
+            if method == "register":
+                error = fresh.registration_error(*args)
+                if error:
+                    fresh.refused.append((*args, error))
+                    refused.add(args)
+                    continue
+            elif method == "attend" and args[:2] in refused:
+                continue
+            getattr(fresh, method)(*args)
+        self.__dict__.update(fresh.__dict__)
+
+
+class PythonBilling:
+    #Billing totals computed with plain Python loops over the store
+    def __init__(self, store):
+        self.store = store
+
+    def client_fees(self):
+        #Base membership fee plus class fees of every billed member, {member_id: total fee}. The class fees are
+        #added one at a time in registration order, as NumpyBilling does (sum() rounds differently since 3.12)
+        fees = {}
+        for member_id, member in self.store.billed_members().items():
+            class_fees = 0.0
+            for class_info in self.store.member_classes(member_id):
+                class_fees += class_info.cost
+            fees[member_id] = MEMBERSHIP_FEES.get(member.membership_type, 0.0) + class_fees
+        return fees
+
+
+class NumpyBilling:
+    #Array-backed billing for large member bases. Class codes and membership types are encoded as integer
+    #indexes and registrations are held as two parallel index arrays, so the per-member totals are a single
+    #bincount call. Gives exactly the same numbers as PythonBilling
+    def __init__(self, store):
+        classes = store.scheduled_classes()
+        self.class_ids = list(classes)
+        class_index = {class_id: i for i, class_id in enumerate(self.class_ids)}
+        self.cost = numpy.array([classes[class_id].cost for class_id in self.class_ids], dtype=numpy.float64)
+
+        members = store.billed_members()
+        self.member_ids = list(members)
+        tiers = list(store.by_type)
+        tier_index = {membership_type: i for i, membership_type in enumerate(tiers)}
+        tier_fee = numpy.array([MEMBERSHIP_FEES.get(t, 0.0) for t in tiers], dtype=numpy.float64)
+        self.tier = numpy.array([tier_index[m.membership_type] for m in members.values()], dtype=numpy.int32)
+        self.base_fee = tier_fee[self.tier] if len(tiers) else numpy.zeros(0)
+
+        # registrations to scheduled classes, in the order each member registered, each class once
+        reg_member, reg_class = [], []
+        for i, member in enumerate(members.values()):
+            for class_id in dict.fromkeys(member.classes):
+                if class_id in class_index:
+                    reg_member.append(i)
+                    reg_class.append(class_index[class_id])
+        self.reg_member = numpy.array(reg_member, dtype=numpy.int64)
+        self.reg_class = numpy.array(reg_class, dtype=numpy.int64)
+
+    def client_fees(self):
+        # bincount adds the weights one at a time in array order, the same order as PythonBilling's loop
+        class_fees = numpy.bincount(self.reg_member, weights=self.cost[self.reg_class], minlength=len(self.member_ids))
+        totals = self.base_fee + class_fees
+        return {member_id: float(totals[i]) for i, member_id in enumerate(self.member_ids)}
+
+
+def billing_engine(store):
+    #NumpyBilling when NumPy is installed and USE_NUMPY is set, PythonBilling otherwise
+    if numpy is not None and USE_NUMPY:
+        return NumpyBilling(store)
+    return PythonBilling(store)
+
+
+# Month-end billing run: one invoice per billed member in exact integer cents, written by a pool of
+# worker processes, one shard file each, plus a manifest with the control totals
+
+def to_cents(amount):
+    #Exact amount in integer cents, invalid amounts count as 0 like in the reports
+    try:
+        return int((Decimal(str(amount).strip()) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        return 0
+
+def format_cents(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+INVOICE_FIELDS = ["invoice", "member_id", "first_name", "last_name", "membership_type",
+                  "base_fee", "classes", "class_fees", "total"]
+
+def bill_shard(task):
+    #Writes the invoices of one shard and marks it done, runs in a worker process.
+    #The invoices are written to a temp file first so a crashed shard never looks finished
+    shard, members, classes, out_dir, period, digest = task
+    filename = os.path.join(out_dir, f"shard-{shard:04d}.csv")
+    totals = {"invoices": 0, "base_cents": 0, "class_cents": 0, "total_cents": 0}
+    with open(filename + ".tmp", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(INVOICE_FIELDS)
+        for member_id, first_name, last_name, membership_type, class_ids in members:
+            base = to_cents(MEMBERSHIP_FEES.get(membership_type, 0))
+            class_fees = sum(classes[class_id][1] for class_id in class_ids)
+            lines = ";".join(f"{class_id}:{classes[class_id][0]}:{format_cents(classes[class_id][1])}"
+                             for class_id in class_ids)
+            writer.writerow([f"{period}-{member_id}", member_id, first_name, last_name, membership_type,
+                             format_cents(base), lines, format_cents(class_fees), format_cents(base + class_fees)])
+            totals["invoices"] += 1
+            totals["base_cents"] += base
+            totals["class_cents"] += class_fees
+            totals["total_cents"] += base + class_fees
+    os.replace(filename + ".tmp", filename)
+    result = dict(totals, shard=shard, file=os.path.basename(filename), digest=digest)
+    with open(os.path.join(out_dir, f"shard-{shard:04d}.done"), "w") as f:
+        json.dump(result, f)
+    return result
+
+@timed("billing_run")
+def billing_run(out_dir, shards=8, workers=None, period=None, store=None):
+    #Bills every member with a membership type: base fee plus registered class costs. Members are spread
+    #over the shards by a hash of their ID. A shard whose done marker matches its current input is skipped,
+    #so re-running after a crash only redoes the unfinished shards. Returns the manifest
+    if store is None:
+        store = GymStore.load()
+    if period is None:
+        period = datetime.now().strftime("%Y-%m")
+    os.makedirs(out_dir, exist_ok=True)
+    classes = {class_id: (gym_class.name, to_cents(gym_class.cost_text) if gym_class.valid_cost() else 0)
+               for class_id, gym_class in store.scheduled_classes().items()}
+    buckets = [[] for _ in range(shards)]
+    for member_id, member in sorted(store.billed_members().items()):
+        class_ids = [class_id for class_id in dict.fromkeys(member.classes) if class_id in classes]
+        buckets[zlib.crc32(member_id.encode()) % shards].append(
+            (member_id, member.first_name, member.last_name, member.membership_type, class_ids))
+
+    results, tasks = {}, []
+    for shard, members in enumerate(buckets):
+        used = {class_id: classes[class_id] for m in members for class_id in m[4]}
+        digest = hashlib.sha256(repr((period, members, sorted(used.items()))).encode()).hexdigest()
+        try:
+            with open(os.path.join(out_dir, f"shard-{shard:04d}.done")) as f:
+                done = json.load(f)
+            if done["digest"] == digest:
+                results[shard] = dict(done, skipped=True)
+                continue
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        tasks.append((shard, members, used, out_dir, period, digest))
+
+    if workers == 1 or len(tasks) <= 1:
+        finished = map(bill_shard, tasks)
+    else:
+        pool = multiprocessing.Pool(workers)
+        finished = pool.imap_unordered(bill_shard, tasks)
+    for result in finished:
+        results[result["shard"]] = dict(result, skipped=False)
+    if len(tasks) > 1 and workers != 1:
+        pool.close()
+        pool.join()
+
+    shard_results = [results[shard] for shard in range(shards)]
+    manifest = {
+        "period": period,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "shards": shard_results,
+        "control_totals": {
+            "invoices": sum(r["invoices"] for r in shard_results),
+            "base_fees": format_cents(sum(r["base_cents"] for r in shard_results)),
+            "class_fees": format_cents(sum(r["class_cents"] for r in shard_results)),
+            "total": format_cents(sum(r["total_cents"] for r in shard_results)),
+            "total_cents": sum(r["total_cents"] for r in shard_results),
+        },
+    }
+    with open(os.path.join(out_dir, "manifest.json.tmp"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(out_dir, "manifest.json.tmp"), os.path.join(out_dir, "manifest.json"))
+    return manifest
+
+
+def split_fields(text):
+    return text.split(",") if text else []
+
+class SQLiteBackend:
+    #Keeps the data in an SQLite database with members, instructors, classes and registrations as indexed
+    #tables. load()/save() exchange the same {id: [fields]} dicts as the text files, journal() only
+    #replaces the changed rows, and the revenue per class and per client are aggregate queries
+    aggregate_queries = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS members (
+            id TEXT PRIMARY KEY, ord INTEGER, first_name TEXT, last_name TEXT,
+            contact_number TEXT, membership_type TEXT);
+        CREATE INDEX IF NOT EXISTS members_type ON members (membership_type);
+        CREATE INDEX IF NOT EXISTS members_ord ON members (ord);
+        CREATE TABLE IF NOT EXISTS instructors (
+            id TEXT PRIMARY KEY, ord INTEGER, first_name TEXT, last_name TEXT,
+            contact_number TEXT, trn TEXT, dob TEXT);
+        CREATE INDEX IF NOT EXISTS instructors_ord ON instructors (ord);
+        CREATE TABLE IF NOT EXISTS other_people (id TEXT PRIMARY KEY, ord INTEGER, fields TEXT);
+        CREATE INDEX IF NOT EXISTS other_people_ord ON other_people (ord);
+        CREATE TABLE IF NOT EXISTS classes (
+            code TEXT PRIMARY KEY, ord INTEGER, name TEXT, day TEXT, time TEXT,
+            cost_text TEXT, cost REAL, instructor TEXT, extra TEXT);
+        CREATE INDEX IF NOT EXISTS classes_ord ON classes (ord);
+        CREATE TABLE IF NOT EXISTS registrations (
+            person_id TEXT, position INTEGER, class_code TEXT, PRIMARY KEY (person_id, position));
+        CREATE INDEX IF NOT EXISTS registrations_class ON registrations (class_code);
+        CREATE TABLE IF NOT EXISTS membership_fees (membership_type TEXT PRIMARY KEY, fee REAL);
+        CREATE TABLE IF NOT EXISTS records (file TEXT, id TEXT, ord INTEGER, fields TEXT, PRIMARY KEY (file, id));
+    """
+    PEOPLE_TABLES = ("members", "instructors", "other_people")
+
+    def __init__(self, path="gym.db"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO membership_fees VALUES (?, ?)", MEMBERSHIP_FEES.items())
+
+    def load(self, filename):
+        if filename == "members.txt":
+            return self.load_people()
+        if filename == "classes.txt":
+            rows = self.db.execute(
+                "SELECT code, name, day, time, cost_text, instructor, extra FROM classes ORDER BY ord")
+            return {row[0]: unpad(row[1:6]) + split_fields(row[6]) for row in rows}
+        rows = self.db.execute("SELECT id, fields FROM records WHERE file = ? ORDER BY ord", (filename,))
+        return {record_id: split_fields(fields) for record_id, fields in rows}
+
+    def load_people(self):
+        classes = {}
+        for person_id, class_code in self.db.execute(
+                "SELECT person_id, class_code FROM registrations ORDER BY person_id, position"):
+            classes.setdefault(person_id, []).append(class_code)
+        people = []
+        for row in self.db.execute(
+                "SELECT ord, id, first_name, last_name, contact_number, membership_type FROM members"):
+            people.append((row[0], row[1], unpad(row[2:]) + classes.get(row[1], [])))
+        for row in self.db.execute(
+                "SELECT ord, id, first_name, last_name, contact_number, trn, dob FROM instructors"):
+            people.append((row[0], row[1], unpad(row[2:]) + classes.get(row[1], [])))
+        for row in self.db.execute("SELECT ord, id, fields FROM other_people"):
+            people.append((row[0], row[1], split_fields(row[2])))
+        people.sort()
+        return {person_id: fields for _, person_id, fields in people}
+
+    def write_person(self, ord, person_id, fields):
+        if person_id.startswith("M"):
+            member = Member.from_fields(person_id, fields)
+            self.db.execute("INSERT INTO members VALUES (?, ?, ?, ?, ?, ?)", (
+                person_id, ord, member.first_name, member.last_name, member.contact_number, member.membership_type))
+            classes = member.classes
+        elif person_id.startswith("I"):
+            instructor = Instructor.from_fields(person_id, fields)
+            self.db.execute("INSERT INTO instructors VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                person_id, ord, instructor.first_name, instructor.last_name, instructor.contact_number,
+                instructor.trn, instructor.dob))
+            classes = instructor.classes
+        else:
+            self.db.execute("INSERT INTO other_people VALUES (?, ?, ?)", (person_id, ord, ",".join(fields)))
+            classes = []
+        self.db.executemany("INSERT INTO registrations VALUES (?, ?, ?)",
+                            [(person_id, position, c) for position, c in enumerate(classes)])
+
+    def write_class(self, ord, class_id, fields):
+        gym_class = GymClass.from_fields(class_id, fields)
+        self.db.execute("INSERT INTO classes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            class_id, ord, gym_class.name, gym_class.day, gym_class.time, gym_class.cost_text, gym_class.cost,
+            gym_class.instructor, ",".join(gym_class.fields()[5:]) or None))
+
+    def find_ord(self, tables, key_column, key, where="", args=()):
+        #Position of an existing row so that a replaced record keeps its place, or the next free position
+        for table in tables:
+            row = self.db.execute(f"SELECT ord FROM {table} WHERE {key_column} = ? {where}", (key,) + args).fetchone()
+            if row:
+                return row[0]
+        return 1 + max(self.db.execute(f"SELECT COALESCE(MAX(ord), 0) FROM {table} WHERE 1 = 1 {where}",
+                                       args).fetchone()[0] for table in tables)
+
+    def save(self, filename, ulist):
+        with self.db:
+            if filename == "members.txt":
+                for table in self.PEOPLE_TABLES + ("registrations",):
+                    self.db.execute(f"DELETE FROM {table}")
+                for ord, person_id in enumerate(ulist):
+                    self.write_person(ord, person_id, ulist[person_id])
+            elif filename == "classes.txt":
+                self.db.execute("DELETE FROM classes")
+                for ord, class_id in enumerate(ulist):
+                    self.write_class(ord, class_id, ulist[class_id])
+            else:
+                self.db.execute("DELETE FROM records WHERE file = ?", (filename,))
+                self.db.executemany("INSERT INTO records VALUES (?, ?, ?, ?)", [
+                    (filename, record_id, ord, ",".join(ulist[record_id])) for ord, record_id in enumerate(ulist)])
+        return True
+
+    def journal(self, filename, ulist, keys, complete=True):
+        #Replaces only the rows of the changed records, in one transaction
+        with self.db:
+            for key in keys:
+                if filename == "members.txt":
+                    ord = self.find_ord(self.PEOPLE_TABLES, "id", key)
+                    for table in self.PEOPLE_TABLES:
+                        self.db.execute(f"DELETE FROM {table} WHERE id = ?", (key,))
+                    self.db.execute("DELETE FROM registrations WHERE person_id = ?", (key,))
+                    self.write_person(ord, key, ulist[key])
+                elif filename == "classes.txt":
+                    ord = self.find_ord(("classes",), "code", key)
+                    self.db.execute("DELETE FROM classes WHERE code = ?", (key,))
+                    self.write_class(ord, key, ulist[key])
+                else:
+                    ord = self.find_ord(("records",), "id", key, "AND file = ?", (filename,))
+                    self.db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+                                    (filename, key, ord, ",".join(ulist[key])))
+        return True
+
+    def compact(self, filename, ulist=None):
+        return True
+
+    def lock_name(self):
+        return self.path + ".lock"
+
+    def data_files(self):
+        return [self.path]
+
+    def version(self, filenames):
+        #SQLite's own counter of commits made by other connections to the database
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def class_revenue(self):
+        #Registrations and revenue per scheduled class, {code: (registrations, revenue)}
+        rows = self.db.execute("""
+            SELECT c.code, COUNT(DISTINCT m.id), c.cost * COUNT(DISTINCT m.id)
+            FROM classes c
+            LEFT JOIN registrations r ON r.class_code = c.code
+            LEFT JOIN members m ON m.id = r.person_id
+            WHERE c.cost_text IS NOT NULL
+            GROUP BY c.code""")
+        return {code: (count, revenue) for code, count, revenue in rows}
+
+    def client_fees(self):
+        #Base membership fee plus class fees of every billed member, {member_id: total fee}
+        rows = self.db.execute("""
+            SELECT m.id, COALESCE(f.fee, 0) + COALESCE(SUM(c.cost), 0)
+            FROM members m
+            LEFT JOIN membership_fees f ON f.membership_type = m.membership_type
+            LEFT JOIN (SELECT DISTINCT person_id, class_code FROM registrations) r ON r.person_id = m.id
+            LEFT JOIN classes c ON c.code = r.class_code AND c.cost_text IS NOT NULL
+            WHERE m.membership_type IS NOT NULL
+            GROUP BY m.id""")
+        return dict(rows.fetchall())
+
+
+# Files that make up the gym data, in the order they are migrated
+DATA_FILES = ("members.txt", "classes.txt", "ids.txt", "aggregates.txt")
+
+
+def migrate(source, target):
+    #Copies all data from one storage backend to another, e.g. migrate(TextBackend(), SQLiteBackend("gym.db"))
+    for filename in DATA_FILES:
+        target.save(filename, source.load(filename))
+
+# Every report is computed by its *_result() function into (summary, rows): a small summary dict and a lazy
+# iterator of rows (lists of strings and numbers that JSON can store), so that a report can be streamed to the
+# console, a pager, a file or the report cache without holding the whole report in memory. Its *_lines()
+# function turns (summary, rows) into the lines of the printed report.
+
+def invalid_cost_warnings(store):
+    return [f"Warning: Invalid cost value for class {class_id}. Using 0.0"
+            for class_id, gym_class in store.scheduled_classes().items() if not gym_class.valid_cost()]
+
+@timed("report:registrations")
+def class_registrations_result(store):
+    classes = store.scheduled_classes()
+    # Counts and revenue come from the database when the backend can aggregate them,
+    # otherwise from the running totals stored with the data
+    revenue = BACKEND.class_revenue() if BACKEND.aggregate_queries else store.aggregates().class_revenue()
+
+    def rows():
+        for class_code in sorted(classes.keys()):
+            registrations, total_revenue = revenue.get(class_code, (0, 0.0))
+            members = sorted(member.full_name() for member in store.class_roster(class_code))
+            yield [class_code, classes[class_code].name, classes[class_code].cost, registrations, total_revenue, members]
+    return {"warnings": invalid_cost_warnings(store)}, rows()
+
+def class_registrations_lines(summary, rows):
+    yield from summary["warnings"]
+
+    # Generate the report
+    yield ""
+    yield "=== CLASS REGISTRATION AND REVENUE REPORT ==="
+    yield ""
+
+    total_classes = 0
+    total_all_revenue = 0.0
+    total_all_members = 0
+    for class_code, class_name, cost, registrations, total_revenue, members in rows:
+        total_classes += 1
+        total_all_revenue += total_revenue
+        total_all_members += registrations
+
+        yield f"Class: {class_name} (Code: {class_code})"
+        yield f"Cost per Member: ${cost:.2f}"
+        yield f"Number of Members: {registrations}"
+        yield f"Total Revenue: ${total_revenue:.2f}"
+        yield ""
+        yield "Registered Members:"
+
+        if members:
+            for member in members:
+                yield f"- {member}"
+        else:
+            yield "- No members registered"
+
+        yield ""
+        yield "-" * 50
+        yield ""
+
+    # Summary of all classes
+    yield "=== SUMMARY ==="
+    yield f"Total Number of Classes: {total_classes}"
+    yield f"Total Number of Registrations: {total_all_members}"
+    yield f"Total Revenue: ${total_all_revenue:.2f}"
+
+def class_registrations(store=None):
+    #Prints the members and revenue of every class
+    run_report("registrations", store)
+
+@timed("report:clients")
+def client_report_result(store):
+    clients = store.billed_members()
+    warnings = invalid_cost_warnings(store)
+    for member_id, client in clients.items():
+        if client.membership_type not in MEMBERSHIP_FEES:
+            warnings.append(f"Warning: Unknown membership type '{client.membership_type}' for client {member_id}")
+    # Total monthly fee for each client: base membership fee plus the cost of all classes,
+    # computed by the database when the backend can aggregate them
+    total_fees = BACKEND.client_fees() if BACKEND.aggregate_queries else billing_engine(store).client_fees()
+
+    def rows():
+        for member_id in sorted(clients.keys()):
+            client = clients[member_id]
+            registered = [[class_info.name, class_info.class_id, class_info.cost] for class_info in store.member_classes(member_id)]
+            yield [member_id, client.first_name, client.last_name, client.membership_type,
+                   MEMBERSHIP_FEES.get(client.membership_type), registered, total_fees[member_id]]
+    return {"warnings": warnings, "clients": len(clients), "total": sum(total_fees.values())}, rows()
+
+def client_report_lines(summary, rows):
+    yield from summary["warnings"]
+
+    # Generate the report
+    yield ""
+    yield "=== GYM CLIENT MONTHLY FEE REPORT ==="
+    yield ""
+
+    for member_id, first_name, last_name, membership_type, base_fee, registered, total_fee in rows:
+        yield f"Client ID: {member_id}"
+        yield f"Name: {first_name} {last_name}"
+        yield f"Membership Type: {membership_type}"
+
+        if base_fee is not None:
+            yield f"Base Membership Fee: ${base_fee:.2f}"
+        else:
+            yield f"Base Membership Fee: Unknown (membership type not found)"
+
+        yield ""
+        yield "Registered Classes:"
+        if registered:
+            class_total = 0.0
+            for name, class_id, cost in registered:
+                yield f"- {name} (ID: {class_id}) - ${cost:.2f}"
+                class_total += cost
+            yield ""
+            yield f"Total Class Fees: ${class_total:.2f}"
+        else:
+            yield "- No additional classes registered"
+            yield ""
+            yield "Total Class Fees: $0.00"
+
+        yield ""
+        yield f"TOTAL MONTHLY FEE: ${total_fee:.2f}"
+        yield ""
+        yield "-" * 50
+        yield ""
+
+    # Summary
+    yield "=== SUMMARY ==="
+    yield f"Total Number of Clients: {summary['clients']}"
+    yield f"Total Monthly Revenue: ${summary['total']:.2f}"
+
+def client_report_record(row):
+    #CSV/JSON columns of a row: the registered classes become their IDs and the sum of their costs
+    member_id, first_name, last_name, membership_type, base_fee, registered, total_fee = row
+    return [member_id, first_name, last_name, membership_type, base_fee,
+            [class_id for _, class_id, _ in registered], sum(cost for _, _, cost in registered), total_fee]
+
+def generate_client_report(store=None):
+    #Prints the monthly fee of every client: base membership fee plus the cost of their classes
+    run_report("clients", store)
+
+def quick_checkin_available():
+    #The indexed check-in path reads and appends members.txt directly, so it needs the text files in journal mode
+    return JOURNAL_MODE and isinstance(BACKEND, TextBackend)
+
+# Attendance history: every check-in is appended as a fixed-size binary record to the file of its day,
+# ATTENDANCE_DIR/YYYYMMDD.bin. Queries open only the days in their range, through a memory map
+ATTENDANCE_DIR = "attendance"
+
+
+class AttendanceLog:
+    RECORD = struct.Struct("<16s8sq")  # member ID and class ID padded with NUL bytes, unix time in seconds
+
+    def __init__(self, directory=ATTENDANCE_DIR):
+        self.directory = directory
+
+    def partition(self, day):
+        return os.path.join(self.directory, day.strftime("%Y%m%d") + ".bin")
+
+    def record(self, member_id, class_id, when=None):
+        #Appends one check-in, a single write of one record so concurrent desks never interleave
+        when = when or datetime.now()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.partition(when), "ab") as f:
+            f.write(self.RECORD.pack(member_id.encode(), class_id.encode(), int(when.timestamp())))
+
+    def records(self, start, end, member_id=None):
+        #Yields (member ID, class ID, time) of the check-ins from day start to day end inclusive,
+        #with member_id only that member's, found by searching the map for the padded ID
+        size = self.RECORD.size
+        key = member_id.encode().ljust(16, b"\0") if member_id is not None else None
+        day = start
+        while day <= end:
+            try:
+                with open(self.partition(day), "rb") as f:
+                    length = os.fstat(f.fileno()).st_size
+                    length -= length % size  # a record cut short by a crash is ignored
+                    if length:
+                        with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ) as mm:
+                            if key is None:
+                                for member, class_id, stamp in self.RECORD.iter_unpack(mm):
+                                    yield member.rstrip(b"\0").decode(), class_id.rstrip(b"\0").decode(), datetime.fromtimestamp(stamp)
+                            else:
+                                position = mm.find(key)
+                                while position != -1:
+                                    if position % size == 0:
+                                        _, class_id, stamp = self.RECORD.unpack_from(mm, position)
+                                        yield member_id, class_id.rstrip(b"\0").decode(), datetime.fromtimestamp(stamp)
+                                        position += size
+                                    else:
+                                        position += 1
+                                    position = mm.find(key, position)
+            except FileNotFoundError:
+                pass
+            day += timedelta(days=1)
+
+    def visits(self, member_id, start, end):
+        #[(time, class ID)] of one member's check-ins
+        return [(when, class_id) for _, class_id, when in self.records(start, end, member_id)]
+
+    def class_weeks(self, start, end):
+        #{(class ID, ISO week such as 2025-W12): check-ins}
+        weeks = {}
+        for _, class_id, when in self.records(start, end):
+            year, week, _ = when.isocalendar()
+            key = (class_id, f"{year}-W{week:02d}")
+            weeks[key] = weeks.get(key, 0) + 1
+        return weeks
+
+    def peak_hours(self, start, end):
+        #Check-ins per hour of the day, a list of 24 counts
+        hours = [0] * 24
+        for _, _, when in self.records(start, end):
+            hours[when.hour] += 1
+        return hours
+
+
+def record_registration_error(member_id, fields, gym_class, totals):
+    #registration_error() for the indexed check-in path: the member's own line tells whether they are registered,
+    #the stored totals give the headcount of a scheduled class
+    if gym_class.class_id in person_from_fields(member_id, fields).classes:
+        return None
+    headcount = totals.classes.get(gym_class.class_id, [0, 0.0])[0]
+    if gym_class.capacity is not None and headcount >= gym_class.capacity:
+        return f"Class {gym_class.class_id} is full ({gym_class.capacity} places)"
+    return None
+
+def register_records(checkins):
+    #Registers members for classes without loading the store: the updated records go to the change journal in
+    #one append and only the stored totals rows of the classes are adjusted. checkins is a list of
+    #(member ID, class ID). Records are reread under the data lock, so concurrent check-ins are never lost.
+    #A member already registered for the class is checked in without any change.
+    #Returns [(member ID, class ID, reason)] of the check-ins that were refused
+    refused = []
+    with data_lock():
+        classes = {class_id: GymClass.from_fields(class_id, fields) for class_id, fields in load("classes.txt").items()}
+        totals = Aggregates.load() or GymStore.load().aggregates()
+        records = {}
+        for member_id, class_id in checkins:
+            fields = records[member_id] if member_id in records else read_indexed_record("members.txt", member_id)
+            if fields is None or class_id not in classes:
+                refused.append((member_id, class_id, "unknown member or class"))
+                continue
+            gym_class = classes[class_id]
+            error = record_registration_error(member_id, fields, gym_class, totals)
+            if error:
+                refused.append((member_id, class_id, error))
+                continue
+            person = person_from_fields(member_id, fields)
+            if class_id in person.classes:
+                continue  # a repeat visit, the member is registered already
+            person.add_class(class_id)
+            records[member_id] = person.fields()
+            # on a member line shorter than its four fixed fields the class lands in one of those and is no registration
+            if isinstance(person, Member) and len(fields) >= 4 and gym_class.scheduled():
+                registrations = totals.classes.get(class_id, [0, 0.0])[0]
+                totals.set_class(class_id, registrations + 1, gym_class.cost)
+        if records:
+            journal("members.txt", records, list(records), complete=False)
+        totals.commit()
+    return refused
+
+# Group commit: with GROUP_COMMIT on, a check-in is queued as a small request file in CHECKIN_SPOOL and
+# whichever terminal gets the data lock next writes every queued request in one go, so a burst of
+# check-ins from several desks costs one journal append and one totals update instead of one each
+GROUP_COMMIT = False
+CHECKIN_SPOOL = "checkins.spool"
+SPOOL_SEQUENCE = itertools.count()
+
+
+def queue_checkin(member_id, class_id):
+    #Queues the check-in and waits until it is written, by this process or by another one that got the lock first.
+    #Returns the reason the check-in was refused, None when it was registered
+    os.makedirs(CHECKIN_SPOOL, exist_ok=True)
+    request = os.path.join(CHECKIN_SPOOL, f"{time.time_ns():020d}-{os.getpid()}-{next(SPOOL_SEQUENCE)}")
+    with open(request + ".tmp", "w") as f:
+        f.write(f"{member_id},{class_id}\n")
+    os.replace(request + ".tmp", request + ".req")
+    with data_lock():
+        if os.path.exists(request + ".req"):
+            flush_checkins()
+        if not os.path.exists(request + ".refused"):
+            return None
+        with open(request + ".refused") as f:
+            reason = f.read().strip()
+        os.remove(request + ".refused")
+        return reason
+
+def flush_checkins():
+    #Writes every queued check-in request, returns how many there were. The reason a request was refused is
+    #left beside it in a .refused file for the terminal that queued it
+    with data_lock():
+        requests = sorted(name for name in os.listdir(CHECKIN_SPOOL) if name.endswith(".req"))
+        checkins = []
+        for name in requests:
+            with open(os.path.join(CHECKIN_SPOOL, name)) as f:
+                checkins.append(tuple(f.read().strip().split(",", 1)))
+        refused = collections.defaultdict(list)
+        for member_id, class_id, reason in register_records(checkins):
+            refused[member_id, class_id].append(reason)
+        # several identical requests are all refused or none is, so which of them takes a reason does not matter
+        for name, checkin in reversed(list(zip(requests, checkins))):
+            if refused.get(checkin):
+                with open(os.path.join(CHECKIN_SPOOL, name[:-len(".req")] + ".refused"), "w") as f:
+                    f.write(refused[checkin].pop() + "\n")
+        for name in requests:
+            os.remove(os.path.join(CHECKIN_SPOOL, name))
+    count("group_commit", "checkins", len(checkins))
+    return len(checkins)
+
+@timed("menu:checkin")
+def checkin(store=None):
+    #Checks in members to the gym, displays data about additional classes and allows members to register.
+    #With the text files in journal mode the check-in is appended to the journal by register_records(), whether
+    #or not a store is given, so no record is loaded to register one; without a store the member is looked up
+    #through the offset index of members.txt. A store answers the lookups, the class listing and the checks.
+    #With a store, anything other than an ID is searched for as the start of a name or phone number
+    quick = quick_checkin_available()
+    if store is None and quick:
+        classes = {class_id: GymClass.from_fields(class_id, fields) for class_id, fields in load("classes.txt").items()}
+        find_member = lambda member_id: read_record("members.txt", member_id)
+    else:
+        store = store or GymStore.load()
+        classes = store.classes
+        find_member = store.people.get
     while True:
         membership_id = input("Enter your valid membership number: ").strip()
-        if membership_id in members:
+        fields = find_member(membership_id) if membership_id else None
+        if fields is not None:
             break
-        else:
+        # Anything else is taken as the start of a name or phone number when the store is loaded
+        matches = store.search(membership_id, store.members) if store is not None and membership_id else []
+        if not matches:
             print("Invalid Membership ID. Please enter a valid membership number.")
+            continue
+        print("\nMatching members:")
+        for number, member_id in enumerate(matches, 1):
+            member = store.members[member_id]
+            print(f"{number}. {member_id} - {member.full_name()} ({member.contact_number or 'no contact number'})")
+        choice = input("Enter the number of the member, or press Enter to search again: ").strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(matches):
+            membership_id = matches[int(choice) - 1]
+            fields = find_member(membership_id)
+            break
     current_date = datetime.now()
-
-    print("\nAvailable Classes for Registration:")
-    for cls, names in classes.items():
-        if names:
-            print("-", cls, names[0])
-        else: 
-            print("")
-
-    selected_class = input("\nEnter the id of the class you want to register for: ").strip()
+    if store is None:
+        totals = Aggregates.load() or GymStore.load().aggregates()
+        registration_error = lambda class_id: record_registration_error(membership_id, fields, classes[class_id], totals)
+    else:
+        registration_error = lambda class_id: store.registration_error(membership_id, class_id)
+
+    # Only the sessions still ahead today are listed, any class ID is accepted
+    schedule = store.schedule if store is not None else ScheduleIndex.build(classes)
+    upcoming = schedule.upcoming(current_date)
+    print(f"\nAvailable Classes for Registration ({WEEKDAYS[current_date.weekday()]}):")
+    if not upcoming:
+        print("No more sessions today.")
+    for cls in upcoming:
+        gym_class = classes[cls]
+        print("-", cls, gym_class.name, f"({gym_class.time})" if gym_class.time else "")
 
     while True:
-        if selected_class in classes:
-            break
-        else:
+        selected_class = input("\nEnter the id of the class you want to register for: ").strip()
+        if selected_class not in classes:
             print("Invalid class selection. Please choose a valid class.")
+        elif registration_error(selected_class):
+            print(registration_error(selected_class) + ". Please choose another class.")
+        else:
+            break
 
-    # Update the member's record with the selected class
-    members[membership_id].append(selected_class)
-
-    # Save the updated members list back to the file
-    save("members.txt", members)
-
-    print("Registration Successful!")
+    # Update the member's record with the selected class and record it in the change journal,
+    # a member already registered for it only has the visit logged
+    if store is not None:
+        repeat = store.registered(membership_id, selected_class)
+    else:
+        repeat = selected_class in person_from_fields(membership_id, fields).classes
+    if quick:
+        if GROUP_COMMIT:
+            reason = queue_checkin(membership_id, selected_class)
+        else:
+            reason = next((reason for _, _, reason in register_records([(membership_id, selected_class)])), None)
+        if reason:
+            # another desk took the last place in the meantime
+            print(f"Registration failed: {reason}")
+            return
+        AttendanceLog().record(membership_id, selected_class, current_date)
+    else:
+        store.register(membership_id, selected_class)
+        store.attend(membership_id, selected_class, current_date)
+        store.commit()
+        if store.refused:
+            print(f"Registration failed: {store.refused[0][2]}")
+            return
+
+    print("Check-in Successful!" if repeat else "Registration Successful!")
     print(f"Membership ID: {membership_id}")
     print(f"Class ID: {selected_class}")
-    print(f"Class Registered: {classes.get(selected_class)[0]}")
+    print(f"Class Registered: {classes[selected_class].name}")
     print(f"Time Registered: {current_date}")
 
+def valid_contact(contact_number):
+    return contact_number.isdigit() and len(contact_number) == 10
+
+def valid_trn(trn):
+    return trn.isdigit() and len(trn) == 9
+
+def valid_dob(dob):
+    return dob.isdigit() and len(dob) == 8
+
+def valid_membership_type(mem_type):
+    return mem_type in MEMBERSHIP_FEES
+
+def valid_session_id(session_id):
+    return len(session_id) == 5 and session_id[0] == 'C' and session_id[1:].isdigit()
+
+def valid_capacity(capacity):
+    return capacity.isdigit() and int(capacity) > 0
+
 def login():
     #Login function to authenticate users, 3 chances are given before shutting down, 
     attempts = 3
@@ -333,95 +2361,460 @@ def login():
     print("Login failed! System shutting down.")
     return False
 
-def add_memb():
-
-    members = load("members.txt")
+@timed("menu:add_member")
+def add_memb(store=None):
     # Add a new member to the gym
+    if store is None:
+        store = GymStore.load()
     first_name = input("Enter first name: ")
     last_name = input("Enter last name: ")
     while True:
         contact_number = input("Enter contact number: ")
-        if contact_number.isdigit() and len(contact_number) == 10:
+        if valid_contact(contact_number):
             break
         else:
             print("Invalid contact number. Please enter a 10 digit number.")
     while True:
         mem_type = input("Enter membership type: ")
-        if mem_type in ["Platinum", "Diamond", "Gold", "Standard"]:
+        if valid_membership_type(mem_type):
             break
         else:
             print("Invalid membership type. Please enter Platinum, Diamond, Gold or Standard.")
-    print("Member added successfully.")
-    while True:
-        mem_number = "M" + str(random.randint(1000, 9999))
-        if mem_number not in members:
-            break
+    mem_number = store.new_id("M")
     print("Membership number: ", mem_number)
-    members[mem_number] = [first_name, last_name, contact_number, mem_type]
+    store.add_member(Member(mem_number, first_name, last_name, contact_number, mem_type))
 
-    if save("members.txt", members):
+    if store.commit():
         print("Member added successfully.")
     
-def add_instruct():
+@timed("menu:add_instructor")
+def add_instruct(store=None):
     #Adds new instructors to the gym, generates a unique identification number for each instructor
-    members = load("members.txt")
+    if store is None:
+        store = GymStore.load()
     first_name = input("Enter first name: ")
     last_name = input("Enter last name: ")
     while True:
         contact_number = input("Enter contact number: ")
-        if contact_number.isdigit() and len(contact_number) == 10:
+        if valid_contact(contact_number):
             break
         else:
             print("Invalid contact number. Please enter a 10 digit number.")
     while True:
         trn = input("Enter a valid Tax Registration Number: ")
-        if trn.isdigit() and len(trn) == 9:
+        if valid_trn(trn):
             break
         else:
             print("Invalid input. Please enter a nine digit number.")
 
     while True:
         dob = input("Enter date of birth (ddmmyyyy): ")
-        if dob.isdigit() and len(dob) == 8:
+        if valid_dob(dob):
             break
         else:
             print("Invalid input. Please enter your date of birth in the format ddmmyyyy: ")
-    while True:
-        mem_number = "I" + str(random.randint(1000, 9999))
-        if mem_number not in members:
-            break
+    mem_number = store.new_id("I")
     print("Instructor identification number: ", mem_number)
-    members[mem_number] = [first_name, last_name, contact_number, trn, dob]
-    save("members.txt", members)
+    store.add_instructor(Instructor(mem_number, first_name, last_name, contact_number, trn, dob))
+    store.commit()
     print("Instructor added successfully.")
 
-def print_report():
-    #Prints reports about the gym, including total members, class schedules, membership summary, class registration summary, client report
+@timed("report:members")
+def member_list_result(store):
+    #Report 1: total number of regular members and their names
+    rows = ([member_id, member.first_name, member.last_name]
+            for member_id, member in store.members.items() if member.last_name is not None)
+    return {"total": len(store.members)}, rows
+
+def member_list_lines(summary, rows):
+    yield f"Total Members: {summary['total']}"
+    yield ""
+    yield "List of Members:"
+    for member_id, first_name, last_name in rows:
+        yield f"{member_id}: {first_name} {last_name}"
+
+def member_list_report(store):
+    run_report("members", store)
+
+@timed("report:schedule")
+def class_schedule_result(store, day=None, instructor=None):
+    #Report 2: day, time, cost and instructor of every session, or of those held on a day and/or by an
+    #instructor, looked up in the schedule index
+    if day is None and instructor is None:
+        class_ids = store.classes
+    else:
+        class_ids = store.schedule.find(day, instructor)
+    rows = ([class_id, gym_class.name, gym_class.day, gym_class.time, gym_class.cost_text,
+             gym_class.instructor or "Not assigned"]
+            for class_id, gym_class in ((c, store.classes[c]) for c in class_ids) if gym_class.scheduled())
+    return {}, rows
+
+def class_schedule_lines(summary, rows):
+    yield "Class Schedules:"
+    yield ""
+    for class_id, name, day, slot, cost, instructor in rows:
+        yield f"ID: {class_id} - {name}"
+        yield f"  Day: {day}"
+        yield f"  Time: {slot}"
+        yield f"  Cost: ${cost}"
+        yield f"  Instructor: {instructor}"
+        yield ""
+
+def class_schedule_report(store):
+    run_report("schedule", store)
+
+@timed("report:membership")
+def membership_summary_result(store):
+    #Report 3: members and monthly fees per membership type, members are already grouped by type in the store.
+    #The rows are the members in tier order, the summary holds the totals of every tier
+    # Counts and fees come from the running totals stored with the data
+    totals = store.aggregates()
+    tiers = []
+    for membership_type in store.by_type:
+        members, fees = totals.tiers.get(membership_type, (0, 0))
+        tiers.append([membership_type, MEMBERSHIP_FEES.get(membership_type, 0), members, fees])
+    rows = ([membership_type, member_id, store.members[member_id].full_name()]
+            for membership_type, member_ids in store.by_type.items() for member_id in member_ids)
+    return {"tiers": tiers, "members": totals.total[2], "fees": totals.total[3]}, rows
+
+def membership_summary_lines(summary, rows):
+    rows = iter(rows)
+    row = next(rows, None)
+    yield ""
+    yield "Membership Summary Report:"
+    for membership_type, fee, members, fees in summary["tiers"]:
+        yield ""
+        yield f"Membership Type: {membership_type}"
+        yield f"Monthly Fee: ${fee:.2f}"
+        yield "Members:"
+        while row is not None and row[0] == membership_type:
+            yield f"- {row[2]}"
+            row = next(rows, None)
+        yield f"Total Members: {members}"
+        yield f"Total Monthly Fees: ${fees:.2f}"
+
+    yield ""
+    yield "Overall Totals:"
+    yield f"Total Members: {summary['members']}"
+    yield f"Total Monthly Fees: ${summary['fees']:.2f}"
+
+def membership_summary_report(store):
+    run_report("membership", store)
+
+@timed("report:summary")
+def summary_report(totals):
+    #Class and membership totals straight from the stored aggregates, without reading the members
+    print("Class Registrations:")
+    for class_id in sorted(totals.classes):
+        registrations, revenue = totals.classes[class_id]
+        print(f"  {class_id}: {registrations} registrations, ${revenue:.2f}")
+    print("\nMemberships:")
+    for membership_type, (members, fees) in totals.tiers.items():
+        print(f"  {membership_type}: {members} members, ${fees:.2f}")
+    registrations, revenue, members, fees = totals.total
+    print("\nTotals:")
+    print(f"Total Registrations: {registrations}")
+    print(f"Total Class Revenue: ${revenue:.2f}")
+    print(f"Total Members: {members}")
+    print(f"Total Monthly Fees: ${fees:.2f}")
+
+def verify_aggregates(store, fix=False):
+    #Recomputes the aggregates from scratch and returns the differences with the stored ones,
+    #with fix=True the stored aggregates are replaced by the recomputed ones
+    actual = Aggregates.build(store)
+    stored = Aggregates.load()
+    if stored is None:
+        problems = ["aggregates.txt is missing"]
+    else:
+        problems = stored.drift(actual)
+    if fix and problems:
+        actual.commit(full=True)
+    return problems
+
+# Reports by menu number and by name on the command line
+REPORTS = {
+    "members": member_list_report,
+    "schedule": class_schedule_report,
+    "membership": membership_summary_report,
+    "registrations": class_registrations,
+    "clients": generate_client_report,
+}
+REPORT_CHOICES = {"1": "members", "2": "schedule", "3": "membership", "4": "registrations", "5": "clients"}
+# The functions behind every report, see run_report(): result, text lines, CSV/JSON column names and the
+# function that turns a row into those columns (None when the row already is)
+REPORT_RESULTS = {
+    "members": (member_list_result, member_list_lines, ["member_id", "first_name", "last_name"], None),
+    "schedule": (class_schedule_result, class_schedule_lines,
+                 ["class_id", "name", "day", "time", "cost", "instructor"], None),
+    "membership": (membership_summary_result, membership_summary_lines, ["membership_type", "member_id", "name"],
+                   None),
+    "registrations": (class_registrations_result, class_registrations_lines,
+                      ["class_id", "name", "cost", "registrations", "revenue", "members"], None),
+    "clients": (client_report_result, client_report_lines,
+                ["member_id", "first_name", "last_name", "membership_type", "base_fee", "classes", "class_fees",
+                 "total_fee"], client_report_record),
+}
+REPORT_FORMATS = ("text", "csv", "json")
+# Lines written at a time by the report outputs, and lines per page of the pager
+REPORT_BLOCK_LINES = 1000
+PAGE_LINES = 40
+
+
+class TextOutput:
+    #Writes the printed report to a stream (sys.stdout by default) in blocks of REPORT_BLOCK_LINES lines
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write_lines(self, lines):
+        stream = self.stream or sys.stdout
+        block = []
+        for line in lines:
+            block.append(line)
+            if len(block) == REPORT_BLOCK_LINES:
+                stream.write("\n".join(block) + "\n")
+                block.clear()
+        if block:
+            stream.write("\n".join(block) + "\n")
+
+    def write(self, name, summary, rows):
+        self.write_lines(REPORT_RESULTS[name][1](summary, rows))
+
+
+class PagerOutput(TextOutput):
+    #Shows the printed report a page at a time on the console. Rows after the page the user quits on are
+    #never computed
+    def __init__(self, page_lines=PAGE_LINES):
+        super().__init__()
+        self.page_lines = page_lines
+
+    def write_lines(self, lines):
+        for number, line in enumerate(lines):
+            if number and number % self.page_lines == 0:
+                sys.stdout.flush()
+                if input("-- More -- (Enter for the next page, q to quit) ").strip().lower() == "q":
+                    return
+            print(line)
+
+
+def report_columns(name, row):
+    record = REPORT_RESULTS[name][3]
+    return record(row) if record else row
+
+
+class CsvOutput:
+    #Writes the rows of a report as CSV under a header of the column names, lists are joined with ";"
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, name, summary, rows):
+        writer = csv.writer(self.stream)
+        writer.writerow(REPORT_RESULTS[name][2])
+        writer.writerows([";".join(map(str, value)) if isinstance(value, list) else value
+                          for value in report_columns(name, row)] for row in rows)
+
+
+class JsonOutput:
+    #Writes {"report": name, "summary": {...}, "rows": [{column: value}, ...]} one row per line, so the
+    #document is never built in memory
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, name, summary, rows):
+        fields = REPORT_RESULTS[name][2]
+        self.stream.write(f'{{"report": {json.dumps(name)}, "summary": {json.dumps(summary)}, "rows": [')
+        separator = "\n"
+        for row in rows:
+            self.stream.write(separator + json.dumps(dict(zip(fields, report_columns(name, row)))))
+            separator = ",\n"
+        self.stream.write("\n]}\n")
+
+
+REPORT_OUTPUTS = {"text": TextOutput, "csv": CsvOutput, "json": JsonOutput}
+
+
+def run_report(name, store=None, output=None, **filters):
+    #Streams a report to output (the console by default). The report is read from the report cache when the
+    #data files have not changed since it was computed, so a repeated report needs neither a load nor the
+    #aggregation; otherwise it is cached as it is written. A store, when given, is what a miss is computed from;
+    #while it holds uncommitted changes or is behind the files the report is computed from it and not cached
+    #filters are passed on to the result function, only the schedule takes any (day, instructor)
+    compute = REPORT_RESULTS[name][0]
+    output = output or TextOutput()
+    if store is not None and (store.log or store.version != BACKEND.version(VERSIONED_FILES)):
+        return output.write(name, *compute(store, **filters))
+    key = REPORT_CACHE.key(name + "".join(f";{k}={v}" for k, v in sorted(filters.items()) if v is not None))
+    cached = REPORT_CACHE.get(key)
+    if cached is None:
+        summary, rows = compute(store or GymStore.load(), **filters)
+        cached = summary, REPORT_CACHE.put(key, summary, rows)
+    output.write(name, *cached)
+
+def write_report(name, report_format="text", filename=None, page_lines=None, branches=None, workers=None, **filters):
+    #Runs a report into a file in one of REPORT_FORMATS, or to the console, a page at a time with page_lines.
+    #Files are written through a large buffer and replaced only once the report is complete.
+    #With branches the report is consolidated over them, see consolidated_result()
+    def run(output):
+        if branches is not None:
+            return run_consolidated_report(name, output, branches, workers)
+        return run_report(name, output=output, **filters)
+
+    if filename is None:
+        if report_format == "text":
+            return run(PagerOutput(page_lines) if page_lines else None)
+        return run(REPORT_OUTPUTS[report_format](sys.stdout))
+    tmp = f"{filename}.{os.getpid()}.tmp"
     try:
-        members_list = []
-
-        with open("members.txt", "r") as file:
-            for line in file:
-                member_data = line.strip().split(",")
-                members_list.append(member_data)
-    except FileNotFoundError:
-        print("Error: members.txt file not found.")
-        return
-
+        with open(tmp, "w", newline="" if report_format == "csv" else None, buffering=1 << 20) as f:
+            run(REPORT_OUTPUTS[report_format](f))
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+# Branches: gyms with their own data directory, listed in BRANCHES_FILE as "name,directory" lines (a relative
+# directory is taken from the file's location). --branch runs any command on one branch, and the reports of
+# CONSOLIDATED_REPORTS can be run over all of them at once, with every ID qualified as branch:ID
+BRANCHES_FILE = "branches.txt"
+BRANCH_SEPARATOR = ":"
+CONSOLIDATED_REPORTS = ("membership", "registrations", "clients")
+
+
+def load_branches(filename=BRANCHES_FILE):
+    #Data directory of every branch by name, in file order. Empty when there is no branches file
     try:
-        with open("classes.txt", "r") as file:
-            class_summary = file.readlines()
+        rows = read_records(filename, {})
     except FileNotFoundError:
-        print("Error: classes.txt file not found.")
-        return
-
-    membership_fees = {
-        "Platinum": 10000,
-        "Diamond": 7500,
-        "Gold": 4000,
-        "Standard": 2000
-    }
-
+        return {}
+    base = os.path.dirname(os.path.abspath(filename))
+    return {name.strip(): os.path.join(base, fields[0].strip()) for name, fields in rows.items() if fields}
+
+def valid_branch_name(name):
+    return bool(name) and BRANCH_SEPARATOR not in name and "," not in name and name == name.strip()
+
+def qualify(branch, record_id):
+    return f"{branch}{BRANCH_SEPARATOR}{record_id}"
+
+def tier_rank(membership_type):
+    #Order of the membership types in consolidated reports: the known types in fee table order, then the others by name
+    known = list(MEMBERSHIP_FEES)
+    return (known.index(membership_type), "") if membership_type in known else (len(known), membership_type)
+
+
+# How the rows of each consolidated report are ordered for the merge, and qualified with their branch
+MERGE_KEYS = {
+    "membership": lambda row: (tier_rank(row[0]), row[1]),
+    "registrations": lambda row: row[0],
+    "clients": lambda row: row[0],
+}
+QUALIFY_ROWS = {
+    "membership": lambda branch, row: [row[0], qualify(branch, row[1]), row[2]],
+    "registrations": lambda branch, row: [qualify(branch, row[0])] + row[1:],
+    "clients": lambda branch, row: [qualify(branch, row[0])] + row[1:5]
+                                   + [[[name, qualify(branch, class_id), cost] for name, class_id, cost in row[5]], row[6]],
+}
+
+
+class SpoolOutput:
+    #Writes a report as JSON lines, the summary and then every row in merge order, for consolidated_result().
+    #The rows of the membership summary come in tier order of the branch and are sorted here; the other
+    #reports are already ordered by ID
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, name, summary, rows):
+        if name == "membership":
+            rows = sorted(rows, key=MERGE_KEYS[name])
+        self.stream.write(json.dumps(summary) + "\n")
+        for row in rows:
+            self.stream.write(json.dumps(row) + "\n")
+
+
+def branch_report(task):
+    #Worker of consolidated_result(): runs one report in a branch directory (from its report cache when the
+    #branch has not changed) into a spool file. The branch is read through a backend of its own, opened here
+    #in the worker: the text files of the branch or the database of the same name in its directory
+    name, directory, spool = task
+    start_dir, backend = os.getcwd(), BACKEND
+    os.chdir(directory)
+    try:
+        if isinstance(backend, SQLiteBackend):
+            use_backend(SQLiteBackend(os.path.basename(backend.path)))
+        else:
+            use_backend(TextBackend())
+        with open(spool, "w", buffering=1 << 20) as f:
+            run_report(name, output=SpoolOutput(f))
+    finally:
+        if isinstance(BACKEND, SQLiteBackend) and BACKEND is not backend:
+            BACKEND.db.close()
+        use_backend(backend)
+        os.chdir(start_dir)
+    return spool
+
+def merge_summaries(name, summaries):
+    #The summary of a consolidated report from the summaries of the branches, by branch name
+    warnings = [f"{branch}: {warning}" for branch, summary in summaries.items() for warning in summary.get("warnings", ())]
+    if name == "registrations":
+        return {"warnings": warnings}
+    if name == "clients":
+        return {"warnings": warnings, "clients": sum(summary["clients"] for summary in summaries.values()),
+                "total": sum(summary["total"] for summary in summaries.values())}
+    tiers = {}
+    for summary in summaries.values():
+        for membership_type, fee, members, fees in summary["tiers"]:
+            tier = tiers.setdefault(membership_type, [membership_type, fee, 0, 0])
+            tier[2] += members
+            tier[3] += fees
+    return {"tiers": [tiers[t] for t in sorted(tiers, key=tier_rank)],
+            "members": sum(summary["members"] for summary in summaries.values()),
+            "fees": sum(summary["fees"] for summary in summaries.values())}
+
+def consolidated_result(name, branches, workers=None):
+    #(summary, rows) of a report over every branch. Each branch is reported by a worker process into a spool
+    #file, then the rows of all spool files are merged one row at a time (a k-way merge on the sorted IDs), so
+    #no process ever holds more than one branch
+    spool_dir = tempfile.mkdtemp(prefix="gym_branches_")
+    tasks = [(name, directory, os.path.join(spool_dir, f"{number}.jsonl"))
+             for number, directory in enumerate(branches.values())]
+    try:
+        if workers == 1 or len(tasks) <= 1:
+            spools = list(map(branch_report, tasks))
+        else:
+            with multiprocessing.Pool(min(workers or os.cpu_count() or 1, len(tasks))) as pool:
+                spools = pool.map(branch_report, tasks)
+        files = [open(spool) for spool in spools]
+    except BaseException:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        raise
+    summaries = {branch: json.loads(f.readline()) for branch, f in zip(branches, files)}
+    merge_key, qualify_row = MERGE_KEYS[name], QUALIFY_ROWS[name]
+
+    def branch_rows(number, branch, f):
+        for line in f:
+            row = json.loads(line)
+            yield merge_key(row), number, qualify_row(branch, row)
+
+    def rows():
+        for _, _, row in heapq.merge(*(branch_rows(number, branch, f)
+                                       for number, (branch, f) in enumerate(zip(branches, files)))):
+            yield row
+
+    def remove_spools():
+        for f in files:
+            f.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    # the spool files go once the rows are done with, also when they were never read (e.g. quit in the pager)
+    merged = rows()
+    weakref.finalize(merged, remove_spools)
+    return merge_summaries(name, summaries), merged
+
+def run_consolidated_report(name, output=None, branches=None, workers=None):
+    #Streams a report over every branch to output (the console by default)
+    branches = load_branches() if branches is None else branches
+    (output or TextOutput()).write(name, *consolidated_result(name, branches, workers))
+
+@timed("menu:print_report")
+def print_report(store=None):
+    #Prints reports about the gym, including total members, class schedules, membership summary, class registration summary, client report
     print("\nREPORTS\n".center(35))
     print("1. Total Members")
     print("2. Class Schedules")
@@ -432,85 +2825,17 @@ def print_report():
 
     choice = input("Enter number: ")
 
-    if choice == '1':
-        # Filter out instructors (IDs starting with 'I')
-        regular_members = [member for member in members_list if member[0].startswith('M')]
-        print("="*35)
-        print(f"Total Members: {len(regular_members)}\n")
-        print("List of Members:")
-        for member in regular_members:
-            if len(member) >= 3:
-                member_id, first_name, last_name = member[:3]
-                print(f"{member_id}: {first_name} {last_name}")
-    
-    elif choice == '2':
-        print("="*35)
-        print("Class Schedules:\n")
-        for class_item in class_summary:
-            class_data = class_item.strip().split(",")
-            if len(class_data) >= 5:
-                class_id, name, day, time, cost, instructor = class_data[0], class_data[1], class_data[2], class_data[3], class_data[4], class_data[5] if len(class_data) > 5 else "Not assigned"
-                print(f"ID: {class_id} - {name}")
-                print(f"  Day: {day}")
-                print(f"  Time: {time}")
-                print(f"  Cost: ${cost}")
-                print(f"  Instructor: {instructor}")
-                print()
-    
-    elif choice == '3':
-        # Organize data by membership type
-        membership_data = {}
-        
-        # Filter for regular members (not instructors)
-        regular_members = [member for member in members_list if member[0].startswith('M')]
-        
-        for member in regular_members:
-            if len(member) >= 5:  # Ensure we have enough fields
-                member_id, first_name, last_name = member[0], member[1], member[2]
-                membership_type = member[4]  # Membership type is at index 4
-                
-                # Look up the monthly fee for the membership type
-                monthly_fee = membership_fees.get(membership_type, 0)
-                
-                # Initialize the membership type if it doesn't exist
-                if membership_type not in membership_data:
-                    membership_data[membership_type] = {
-                        "members": [],
-                        "total_fees": 0
-                    }
-                
-                # Add a member to the membership type group
-                membership_data[membership_type]["members"].append((first_name, last_name))
-                membership_data[membership_type]["total_fees"] += monthly_fee
-        print("="*35)
-        print("\nMembership Summary Report:")
-        for membership_type, data in membership_data.items():
-            print(f"\nMembership Type: {membership_type}")
-            print(f"Monthly Fee: ${membership_fees.get(membership_type, 0):.2f}")
-            print("Members:")
-            for first_name, last_name in data["members"]:
-                print(f"- {first_name} {last_name}")
-            print(f"Total Members: {len(data['members'])}")
-            print(f"Total Monthly Fees: ${data['total_fees']:.2f}")
-        
-        # Display overall totals
-        total_members = sum(len(data["members"]) for data in membership_data.values())
-        total_fees = sum(data["total_fees"] for data in membership_data.values())
-        
-        print("\nOverall Totals:")
-        print(f"Total Members: {total_members}")
-        print(f"Total Monthly Fees: ${total_fees:.2f}")
-    
-    elif choice == '4':
+    if choice in REPORT_CHOICES:
+        filters = {}
+        if REPORT_CHOICES[choice] == "schedule":
+            # Enter keeps every day or every instructor
+            filters["day"] = input("Day (press Enter for every day): ").strip() or None
+            filters["instructor"] = input("Instructor (press Enter for every instructor): ").strip() or None
         print("="*35)
-        class_registrations()
-    
-    elif choice == '5':
-        print("="*35)
-        generate_client_report()
+        run_report(REPORT_CHOICES[choice], store, **filters)
     
     elif choice == '6':
-        display_menu()
+        return
     
     else:
         print("Invalid option! Please try again.")
@@ -529,16 +2854,18 @@ def exit_program():
         else:
             print("Invalid input! Please enter 'Y' for Yes or 'N' for No.")
 
-def add_update_session():
+@timed("menu:add_update_session")
+def add_update_session(store=None):
     #Adds new sessions and updates existing sessions
-    sessions = load("classes.txt")
+    if store is None:
+        store = GymStore.load()
     print("1. Add New Session\n2. Update Existing Session\n3. Exit")
     choice = input("Enter number: ")
     if choice == "1":
     # Add new session
         while True:
             session_id = input("Enter Session ID: ")
-            if len(session_id) == 5 and session_id[0] == 'C' and session_id[1:].isdigit():
+            if valid_session_id(session_id):
                 break
             else:
                 print("Invalid input. Please enter the session ID in the format C0000.")
@@ -548,41 +2875,41 @@ def add_update_session():
         session_time = input("Enter the Time: ").capitalize()
         session_cost = input("Enter the Cost of the Session: ")
         instructor = input("Enter the Name of the Instructor: ")
+        while True:
+            capacity = input("Enter the Capacity (or press Enter for no limit): ").strip()
+            if not capacity or valid_capacity(capacity):
+                break
+            else:
+                print("Invalid capacity. Please enter a whole number of places.")
         
-        # Match the format in classes.txt: [name, day, time, cost, instructor]
-        sessions[session_id] = [session_name, session_day, session_time, session_cost, instructor]
-        if save("classes.txt",sessions):
+        # Match the format in classes.txt: [name, day, time, cost, instructor, capacity]
+        store.set_class(GymClass(session_id, session_name, session_day, session_time, session_cost, instructor,
+                                 capacity or None))
+        if store.commit():
             print("New session successfully added!")
     elif choice == "2":
     # Update session
         while True:
             session_id = input("Enter the Session ID you want to update: ")
-            if session_id in sessions:
+            if session_id in store.classes:
                 break
             else:
                 print("Invalid input. Please enter a valid session ID.")
         
         new_name = input("Enter New Session Name (or press Enter to keep the current name): ")
-        if new_name:
-            sessions[session_id][0] = new_name
-            
         new_day = input("Enter New Days (or press Enter to keep the current days): ")
-        if new_day:
-            sessions[session_id][1] = new_day
-            
         new_time = input("Enter New Time (or press Enter to keep the current time): ")
-        if new_time:
-            sessions[session_id][2] = new_time
-            
         new_cost = input("Enter New Cost (or press Enter to keep the current cost): ")
-        if new_cost:
-            sessions[session_id][3] = new_cost
-            
         new_instructor = input("Enter New Instructor Name (or press Enter to keep the current instructor): ")
-        if new_instructor:
-            sessions[session_id][4] = new_instructor
+        while True:
+            new_capacity = input("Enter New Capacity (or press Enter to keep the current capacity): ").strip()
+            if not new_capacity or valid_capacity(new_capacity):
+                break
+            else:
+                print("Invalid capacity. Please enter a whole number of places.")
 
-        if save("classes.txt",sessions):    
+        store.update_class(session_id, new_name, new_day, new_time, new_cost, new_instructor, new_capacity)
+        if store.commit():
             print("Session successfully updated!")
         
     else:
@@ -590,6 +2917,9 @@ def add_update_session():
         return    
     
 def display_menu():
+    #The store stays loaded for the whole session: every action commits its changes straight to the files,
+    #and the store is only reloaded when another process has changed them since
+    store = None
     while True:
         print("\n")
         print("=" * 35)
@@ -603,23 +2933,622 @@ def display_menu():
         print("=" * 35)
 
         choice = input("Enter number: ")
+        if choice in ('1', '2', '3', '4', '5'):
+            store = store.current() if store is not None else GymStore.load()
 
         if choice == '1':
-            checkin()
+            checkin(store)
         elif choice == '2':
-            add_memb()
+            add_memb(store)
         elif choice == '3':
-            add_update_session()
+            add_update_session(store)
         elif choice == '4':
-            add_instruct()
+            add_instruct(store)
         elif choice == '5':
-            print_report()
+            print_report(store)
         elif choice == '6':
             exit_program()
         else:
             print("Invalid option! Please try again.")
 
-def main():
+# Batch operations for the command line. Each takes the store and the fields of one record,
+# applies it in memory and returns a line to print, or raises ValueError for an invalid record
+
+def batch_checkin(store, fields):
+    if len(fields) != 2:
+        raise ValueError("expected MEMBER_ID,CLASS_ID")
+    membership_id, selected_class = fields
+    if membership_id not in store.people:
+        raise ValueError(f"Invalid Membership ID {membership_id}")
+    if selected_class not in store.classes:
+        raise ValueError(f"Invalid class selection {selected_class}")
+    error = store.registration_error(membership_id, selected_class)
+    if error:
+        raise ValueError(error)
+    store.register(membership_id, selected_class)
+    store.attend(membership_id, selected_class)
+    return f"{membership_id},{selected_class}"
+
+def check_fields(fields, size, usage):
+    if len(fields) != size:
+        raise ValueError(f"expected {usage}")
+    if any("," in field for field in fields):
+        raise ValueError("fields cannot contain commas")
+
+def check_member_fields(fields):
+    #Same rules as add_memb(), raises ValueError for an invalid member
+    check_fields(fields, 4, "FIRST,LAST,CONTACT,TYPE")
+    if not valid_contact(fields[2]):
+        raise ValueError("Invalid contact number. Please enter a 10 digit number.")
+    if not valid_membership_type(fields[3]):
+        raise ValueError("Invalid membership type. Please enter Platinum, Diamond, Gold or Standard.")
+
+def check_instructor_fields(fields):
+    #Same rules as add_instruct(), raises ValueError for an invalid instructor
+    check_fields(fields, 5, "FIRST,LAST,CONTACT,TRN,DOB")
+    if not valid_contact(fields[2]):
+        raise ValueError("Invalid contact number. Please enter a 10 digit number.")
+    if not valid_trn(fields[3]):
+        raise ValueError("Invalid Tax Registration Number. Please enter a nine digit number.")
+    if not valid_dob(fields[4]):
+        raise ValueError("Invalid date of birth. Please use the format ddmmyyyy.")
+
+def batch_add_member(store, fields):
+    check_member_fields(fields)
+    mem_number = store.new_id("M")
+    store.add_member(Member(mem_number, *fields))
+    return mem_number
+
+def batch_add_instructor(store, fields):
+    check_instructor_fields(fields)
+    mem_number = store.new_id("I")
+    store.add_instructor(Instructor(mem_number, *fields))
+    return mem_number
+
+def batch_add_session(store, fields):
+    if len(fields) not in (6, 7):
+        raise ValueError("expected ID,NAME,DAY,TIME,COST,INSTRUCTOR[,CAPACITY]")
+    session_id, session_name, session_day, session_time, session_cost, instructor = fields[:6]
+    capacity = fields[6] if len(fields) == 7 and fields[6] else None
+    if not valid_session_id(session_id):
+        raise ValueError("Invalid session ID. Please use the format C0000.")
+    if capacity is not None and not valid_capacity(capacity):
+        raise ValueError("Invalid capacity. Please enter a whole number of places.")
+    store.set_class(GymClass(session_id, session_name, session_day.capitalize(), session_time.capitalize(),
+                             session_cost, instructor, capacity))
+    return session_id
+
+def batch_update_session(store, fields):
+    if len(fields) not in (6, 7):
+        raise ValueError("expected ID,NAME,DAY,TIME,COST,INSTRUCTOR[,CAPACITY] (empty fields keep the current value)")
+    session_id = fields[0]
+    if session_id not in store.classes:
+        raise ValueError(f"Invalid session ID {session_id}")
+    if len(fields) == 7 and fields[6] and not valid_capacity(fields[6]):
+        raise ValueError("Invalid capacity. Please enter a whole number of places.")
+    store.update_class(*fields)
+    return session_id
+
+BATCH_COMMANDS = {
+    "checkin": (batch_checkin, "MEMBER_ID CLASS_ID", "register members for classes"),
+    "add-member": (batch_add_member, "FIRST LAST CONTACT TYPE", "add members"),
+    "add-instructor": (batch_add_instructor, "FIRST LAST CONTACT TRN DOB", "add instructors"),
+    "add-session": (batch_add_session, "ID NAME DAY TIME COST INSTRUCTOR [CAPACITY]", "add sessions"),
+    "update-session": (batch_update_session, "ID NAME DAY TIME COST INSTRUCTOR [CAPACITY]",
+                       "update sessions, empty fields are kept"),
+}
+
+def read_batch(fields, stream):
+    #Yields (line number, fields) for the record given on the command line, or for every
+    #comma separated line read from the stream when no fields were given
+    if fields:
+        yield 0, [f.strip() for f in fields]
+        return
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if line:
+            yield line_number, [f.strip() for f in line.split(",")]
+
+def run_batch(store, operation, records):
+    #Applies one operation to every record with a single load and a single commit,
+    #invalid records are reported on stderr and skipped. Returns the number of rejected records
+    errors = 0
+    for line_number, fields in records:
+        try:
+            print(operation(store, fields))
+        except ValueError as e:
+            errors += 1
+            print(f"line {line_number}: {e}" if line_number else str(e), file=sys.stderr)
+    store.commit()
+    # check-ins another process made impossible before the commit
+    for member_id, class_id, reason in store.refused:
+        errors += 1
+        print(f"{member_id},{class_id}: {reason}", file=sys.stderr)
+    return errors
+
+# Bulk import: (ID prefix, field check, record type, header line) per kind of record
+IMPORT_KINDS = {
+    "members": ("M", check_member_fields, Member, ["first_name", "last_name", "contact_number", "membership_type"]),
+    "instructors": ("I", check_instructor_fields, Instructor, ["first_name", "last_name", "contact_number", "trn", "dob"]),
+}
+IMPORT_CHUNK_SIZE = 10000
+
+@timed("import_csv")
+def import_csv(filename, kind, error_filename=None, chunk_size=IMPORT_CHUNK_SIZE, store=None):
+    #Streams a CSV of members or instructors into the store. Rows are validated a chunk at a time,
+    #IDs are reserved in one block per chunk and everything is written with a single save at the end.
+    #Rejected rows go to the error file with their line number. Returns (imported, rejected)
+    prefix, check, record_type, header = IMPORT_KINDS[kind]
+    if store is None:
+        store = GymStore.load()
+    if error_filename is None:
+        error_filename = filename + ".errors.csv"
+    imported = rejected = 0
+    error_file = None
+    try:
+        with open(filename, newline="") as f:
+            reader = csv.reader(f)
+            numbered = ((reader.line_num, row) for row in reader)
+            while True:
+                chunk = list(itertools.islice(numbered, chunk_size))
+                if not chunk:
+                    break
+                valid = []
+                for line_number, row in chunk:
+                    fields = [field.strip() for field in row]
+                    if not any(fields) or (line_number == 1 and [field.lower() for field in fields] == header):
+                        continue
+                    try:
+                        check(fields)
+                        valid.append(fields)
+                    except ValueError as e:
+                        if error_file is None:
+                            error_file = open(error_filename, "w", newline="")
+                            errors = csv.writer(error_file)
+                            errors.writerow(["line", "error", "row"])
+                        errors.writerow([line_number, e, ",".join(row)])
+                        rejected += 1
+                for new_id, fields in zip(store.reserve_ids(prefix, len(valid)), valid):
+                    if prefix == "M":
+                        store.add_member(record_type(new_id, *fields))
+                    else:
+                        store.add_instructor(record_type(new_id, *fields))
+                imported += len(valid)
+    finally:
+        if error_file is not None:
+            error_file.close()
+    store.commit(full=True)
+    return imported, rejected
+
+# Local service: one long-running process keeps the store in memory and answers requests from the command
+# line and the desks over a local socket. The protocol is one JSON object per line each way:
+#   {"op": "checkin", "fields": ["M1001", "C0002"]}  ->  {"ok": true, "result": "M1001,C0002"}
+#   {"op": "report", "type": "members"}              ->  {"ok": true, "result": "<report text>"}
+# op is one of the batch commands, "report" or "summary"
+SERVICE_ADDRESS = "127.0.0.1:8750"
+SERVICE_COMMIT_INTERVAL = 0.1
+
+
+def parse_address(address):
+    #("unix", path) for a socket path such as unix:/run/gym.sock or ./gym.sock, ("tcp", (host, port)) for host:port
+    if address.startswith("unix:"):
+        return "unix", address[5:]
+    host, _, port = address.rpartition(":")
+    if "/" in address or not port.isdigit():
+        return "unix", address
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+class GymService:
+    #Serves the batch commands and the reports from one store held in memory. Requests run one at a time on
+    #the event loop, so they never interleave. Writes are applied at once but committed together every
+    #commit_interval seconds, and their replies are only sent after the commit that made them durable
+    def __init__(self, store=None, commit_interval=SERVICE_COMMIT_INTERVAL):
+        self.store = store or GymStore.load()
+        self.commit_interval = commit_interval
+        self.committed = None  # future of the next commit, None while nothing waits for one
+        self.checkins = {}     # (member ID, class ID) -> reply of each check-in waiting for the next commit
+
+    def refresh(self):
+        #Reloads the store when another process changed the data and nothing is waiting to be committed here
+        self.store = self.store.current()
+
+    def execute(self, request):
+        #Runs one request, returns (reply, future of the commit the reply has to wait for or None)
+        op = request.get("op")
+        try:
+            if op in BATCH_COMMANDS:
+                self.refresh()
+                result = timed("service:" + op)(BATCH_COMMANDS[op][0])(self.store, request.get("fields", []))
+                if self.committed is None:
+                    self.committed = asyncio.get_running_loop().create_future()
+                reply = {"ok": True, "result": result}
+                if op == "checkin":
+                    self.checkins[tuple(request["fields"])] = reply
+                return reply, self.committed
+            if op in ("report", "summary"):
+                self.refresh()
+                text = io.StringIO()
+                with contextlib.redirect_stdout(text):
+                    if op == "summary":
+                        summary_report(self.store.aggregates())
+                    else:
+                        filters = {k: request[k] for k in ("day", "instructor")
+                                   if request.get(k) and request["type"] == "schedule"}
+                        timed("service:report")(run_report)(request["type"], self.store, **filters)
+                return {"ok": True, "result": text.getvalue()}, None
+            return {"ok": False, "error": f"unknown request {op!r}"}, None
+        except (ValueError, KeyError) as e:
+            return {"ok": False, "error": str(e)}, None
+
+    @timed("service_commit")
+    def commit(self):
+        if self.committed is None:
+            return
+        committed, self.committed = self.committed, None
+        checkins, self.checkins = self.checkins, {}
+        try:
+            self.store.commit()
+            # a check-in refused on commit is answered with the reason, like one refused straight away
+            for member_id, class_id, reason in self.store.refused:
+                checkins[member_id, class_id].update(ok=False, error=reason)
+                del checkins[member_id, class_id]["result"]
+            committed.set_result(True)
+        except Exception as e:
+            # the uncommitted changes are dropped, the clients are told they failed and the service carries on
+            count("service_commit", "failed")
+            self.store.discard()
+            committed.set_exception(e)
+
+    async def commit_periodically(self):
+        while True:
+            await asyncio.sleep(self.commit_interval)
+            self.commit()
+
+    async def handle(self, reader, writer):
+        #Reads the requests of one connection; replies go out in request order through send()
+        replies = asyncio.Queue()
+        sender = asyncio.create_task(self.send(replies, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    await replies.put(({"ok": False, "error": "invalid JSON"}, None))
+                    continue
+                await replies.put(self.execute(request))
+        finally:
+            await replies.put(None)
+            await sender
+            writer.close()
+
+    async def send(self, replies, writer):
+        while True:
+            item = await replies.get()
+            if item is None:
+                break
+            reply, committed = item
+            if committed is not None:
+                try:
+                    await committed
+                except Exception as e:
+                    reply = {"ok": False, "error": f"commit failed: {e}"}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            try:
+                await writer.drain()
+            except ConnectionError:
+                break
+
+    async def serve(self, address=SERVICE_ADDRESS):
+        kind, where = parse_address(address)
+        if kind == "unix":
+            server = await asyncio.start_unix_server(self.handle, where)
+        else:
+            server = await asyncio.start_server(self.handle, *where)
+        committer = asyncio.create_task(self.commit_periodically())
+        stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signum, stopped.set)
+            except NotImplementedError:
+                pass  # Windows, Ctrl+C still ends the service through KeyboardInterrupt
+        print(f"Serving on {address}", flush=True)
+        try:
+            async with server:
+                await stopped.wait()
+        finally:
+            committer.cancel()
+            self.commit()
+            if kind == "unix":
+                os.remove(where)
+
+
+class ServiceClient:
+    #Blocking client of GymService, used by the command line with --server
+    def __init__(self, address=SERVICE_ADDRESS):
+        kind, where = parse_address(address)
+        if kind == "unix":
+            self.socket = socket.socket(socket.AF_UNIX)
+            self.socket.connect(where)
+        else:
+            self.socket = socket.create_connection(where)
+        self.stream = self.socket.makefile("rwb")
+
+    def requests(self, requests):
+        #Sends all requests before reading the replies, so a batch waits for one commit and not one per record
+        for request in requests:
+            self.stream.write(json.dumps(request).encode() + b"\n")
+        self.stream.flush()
+        for _ in requests:
+            line = self.stream.readline()
+            if not line:
+                raise ConnectionError("service closed the connection")
+            yield json.loads(line)
+
+    def request(self, request):
+        return next(self.requests([request]))
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+
+def run_remote(args):
+    #Runs a command against the service at args.server instead of the files
+    client = ServiceClient(args.server)
+    try:
+        if args.command in ("report", "summary"):
+            reply = client.request({"op": args.command, "type": getattr(args, "type", None),
+                                    "day": getattr(args, "day", None), "instructor": getattr(args, "instructor", None)})
+            if not reply["ok"]:
+                print(reply["error"], file=sys.stderr)
+                return 1
+            if getattr(args, "output", None):
+                with open(args.output, "w") as f:
+                    f.write(reply["result"])
+            elif getattr(args, "page", None):
+                PagerOutput(args.page).write_lines(reply["result"].splitlines())
+            else:
+                print(reply["result"], end="")
+            return 0
+        records = list(read_batch(args.fields, sys.stdin))
+        errors = 0
+        for (line_number, _), reply in zip(records, client.requests(
+                [{"op": args.command, "fields": fields} for _, fields in records])):
+            if reply["ok"]:
+                print(reply["result"])
+            else:
+                errors += 1
+                print(f"line {line_number}: {reply['error']}" if line_number else reply["error"], file=sys.stderr)
+        return 1 if errors else 0
+    finally:
+        client.close()
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="gym_billing.py",
+        description="Gym Billing System. Without a command the interactive menu is started.")
+    parser.add_argument("--data-dir", help="directory holding members.txt and classes.txt (default: current directory)")
+    parser.add_argument("--branch", help=f"run the command on the data directory of this branch, see {BRANCHES_FILE}")
+    parser.add_argument("--backend", choices=["text", "sqlite"], default="text", help="storage backend (default: text)")
+    parser.add_argument("--db", default="gym.db", help="SQLite database of the sqlite backend (default: gym.db)")
+    parser.add_argument("--metrics", help="record timings and counters and write them to this file on exit "
+                                          "(JSON for a .json name, Prometheus text otherwise)")
+    parser.add_argument("--metrics-interval", type=float, help="also write the metrics file every this many seconds")
+    parser.add_argument("--server", help="send the command to the service listening at this address "
+                                         "(host:port or a Unix socket path) instead of using the files")
+    parser.add_argument("--no-report-cache", action="store_true", help="always compute reports from the data")
+    parser.add_argument("--no-snapshot", action="store_true", help="always read the CSV data files, not their binary snapshots")
+    parser.add_argument("--group-commit", action="store_true",
+                        help="queue interactive check-ins so concurrent terminals write them in batches")
+    commands = parser.add_subparsers(dest="command")
+    for name, (operation, usage, summary) in BATCH_COMMANDS.items():
+        command = commands.add_parser(
+            name, help=summary,
+            description=f"Fields: {usage}. Without fields, one record per line is read from stdin as {usage.replace(' ', ',')}.")
+        command.add_argument("fields", nargs="*")
+    command = commands.add_parser("import", help="bulk import members or instructors from a CSV file")
+    command.add_argument("kind", choices=list(IMPORT_KINDS))
+    command.add_argument("file", help="CSV with the same fields as add-member/add-instructor, optional header line")
+    command.add_argument("--errors", help="where rejected rows are written (default: FILE.errors.csv)")
+    command.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    command = commands.add_parser("migrate", help="copy all data between the text files and the SQLite database")
+    command.add_argument("target", choices=["text", "sqlite"], help="backend to copy the data to")
+    command = commands.add_parser("bill", help="month-end billing run: write one invoice per member")
+    command.add_argument("out_dir", help="directory for the invoice shards and manifest.json")
+    command.add_argument("--period", help="billing period used in the invoice numbers (default: this month, YYYY-MM)")
+    command.add_argument("--shards", type=int, default=8)
+    command.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    commands.add_parser("summary", help="print the stored class and membership totals")
+    command = commands.add_parser("verify", help="recompute the stored totals from scratch and report any drift")
+    command.add_argument("--fix", action="store_true", help="replace the stored totals with the recomputed ones")
+    command = commands.add_parser("report", help="print one of the reports")
+    command.add_argument("type", choices=list(REPORTS))
+    command.add_argument("--day", help="schedule: only the sessions held on this weekday")
+    command.add_argument("--instructor", help="schedule: only the sessions of this instructor")
+    command.add_argument("--format", choices=REPORT_FORMATS, default="text", help="text (default), csv or json")
+    command.add_argument("--output", help="write the report to this file instead of the console")
+    command.add_argument("--page", type=int, nargs="?", const=PAGE_LINES, metavar="LINES",
+                         help=f"show the text report a page at a time (default {PAGE_LINES} lines)")
+    command.add_argument("--all-branches", action="store_true",
+                         help=f"one report over every branch, with branch-qualified IDs ({', '.join(CONSOLIDATED_REPORTS)})")
+    command.add_argument("--workers", type=int, help="--all-branches: worker processes (default: one per CPU)")
+    command = commands.add_parser("branches", help=f"list the branches of {BRANCHES_FILE}, or add one")
+    command.add_argument("--add", nargs=2, metavar=("NAME", "DIR"), help="add a branch with its data directory")
+    command = commands.add_parser("attendance", help="query the check-in history")
+    command.add_argument("query", choices=["visits", "classes", "peak"],
+                         help="visits of one member, check-ins per class per week, or check-ins per hour of the day")
+    command.add_argument("member_id", nargs="?", help="member whose visits are listed")
+    command.add_argument("--from", dest="start", help="first day, YYYY-MM-DD (default: 30 days before --to)")
+    command.add_argument("--to", dest="end", help="last day, YYYY-MM-DD (default: today)")
+    command = commands.add_parser("serve", help="run the local service that keeps the data in memory")
+    command.add_argument("--listen", default=SERVICE_ADDRESS, help=f"host:port or Unix socket path (default: {SERVICE_ADDRESS})")
+    command.add_argument("--commit-interval", type=float, default=SERVICE_COMMIT_INTERVAL,
+                         help="seconds between the batched commits of the writes")
+    return parser
+
+def attendance_report(args):
+    end = datetime.strptime(args.end, "%Y-%m-%d").date() if args.end else datetime.now().date()
+    start = datetime.strptime(args.start, "%Y-%m-%d").date() if args.start else end - timedelta(days=29)
+    log = AttendanceLog()
+    if args.query == "visits":
+        if not args.member_id:
+            print("attendance visits needs a member ID", file=sys.stderr)
+            return 2
+        visits = log.visits(args.member_id, start, end)
+        for when, class_id in visits:
+            print(f"{when:%Y-%m-%d %H:%M} {class_id}")
+        print(f"Visits by {args.member_id} from {start} to {end}: {len(visits)}")
+    elif args.query == "classes":
+        for (class_id, week), visits in sorted(log.class_weeks(start, end).items()):
+            print(f"{class_id} {week} {visits}")
+    else:
+        hours = log.peak_hours(start, end)
+        busiest = max(hours)
+        for hour, visits in enumerate(hours):
+            if visits:
+                print(f"{hour:02d}:00 {visits:6d} {'#' * round(40 * visits / busiest)}")
+    return 0
+
+REMOTE_COMMANDS = set(BATCH_COMMANDS) | {"report", "summary"}
+
+
+def branches_command(args):
+    #Lists the branches with their data directories, after adding one with --add
+    branches = load_branches()
+    if args.add:
+        name, directory = args.add
+        if not valid_branch_name(name):
+            print(f"Invalid branch name {name!r}: it cannot be empty or contain '{BRANCH_SEPARATOR}' or ','",
+                  file=sys.stderr)
+            return 2
+        if name in branches:
+            print(f"Branch {name} already exists", file=sys.stderr)
+            return 2
+        if "," in directory or not os.path.isdir(directory):
+            print(f"No directory {directory}", file=sys.stderr)
+            return 2
+        with open(BRANCHES_FILE, "a") as f:
+            f.write(f"{name},{directory}\n")
+        branches = load_branches()
+    for name, directory in branches.items():
+        print(f"{name}: {directory}")
+    return 0
+
+
+def run_command(args):
+    # The service only prints reports of its own data as text, other formats and consolidated reports are
+    # written from the files
+    if (args.server and args.command in REMOTE_COMMANDS and getattr(args, "format", "text") == "text"
+            and not getattr(args, "all_branches", False)):
+        return run_remote(args)
+    if args.command == "serve":
+        service = GymService(commit_interval=args.commit_interval)
+        try:
+            asyncio.run(service.serve(args.listen))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if args.command == "attendance":
+        return attendance_report(args)
+    if args.command == "migrate":
+        text, database = TextBackend(), SQLiteBackend(args.db)
+        if args.target == "sqlite":
+            migrate(text, database)
+        else:
+            migrate(database, text)
+        print(f"Data copied to the {args.target} backend")
+        return 0
+    if args.command == "report":
+        if args.type != "schedule" and (args.day or args.instructor):
+            print("--day and --instructor only apply to the schedule report", file=sys.stderr)
+            return 2
+        if args.day and weekday_number(args.day) is None:
+            print(f"Unknown day {args.day}, use a weekday name such as Monday", file=sys.stderr)
+            return 2
+        if args.page and (args.format != "text" or args.output):
+            print("--page only applies to a text report on the console", file=sys.stderr)
+            return 2
+        branches = None
+        if args.all_branches:
+            branches = load_branches()
+            if args.type not in CONSOLIDATED_REPORTS:
+                print(f"--all-branches only applies to the {', '.join(CONSOLIDATED_REPORTS)} reports", file=sys.stderr)
+                return 2
+            if not branches:
+                print(f"No branches in {BRANCHES_FILE}", file=sys.stderr)
+                return 2
+        write_report(args.type, args.format, args.output, args.page, branches, args.workers,
+                     **({"day": args.day, "instructor": args.instructor} if args.type == "schedule" else {}))
+        return 0
+    if args.command == "branches":
+        return branches_command(args)
+    if args.command == "bill":
+        store = GymStore.load()
+        manifest = billing_run(args.out_dir, args.shards, args.workers, args.period, store)
+        control = manifest["control_totals"]
+        skipped = sum(1 for shard in manifest["shards"] if shard["skipped"])
+        print(f"Invoices: {control['invoices']} ({skipped} of {args.shards} shards already done)")
+        print(f"Base Membership Fees: ${control['base_fees']}")
+        print(f"Class Fees: ${control['class_fees']}")
+        print(f"Total: ${control['total']}")
+        report_total = sum(billing_engine(store).client_fees().values())
+        if f"{report_total:.2f}" != control["total"]:
+            print(f"Warning: client report total is ${report_total:.2f}, class costs with fractions of a cent were rounded")
+            return 1
+        return 0
+    if args.command == "summary":
+        totals = Aggregates.load()
+        if totals is None:
+            totals = GymStore.load().aggregates()
+        summary_report(totals)
+        return 0
+    if args.command == "verify":
+        problems = verify_aggregates(GymStore.load(), args.fix)
+        for problem in problems:
+            print(problem)
+        if not problems:
+            print("Aggregates match the data.")
+        elif args.fix:
+            print("Aggregates rebuilt.")
+        return 1 if problems and not args.fix else 0
+    if args.command == "import":
+        imported, rejected = import_csv(args.file, args.kind, args.errors, args.chunk_size)
+        print(f"Imported {imported} {args.kind}, rejected {rejected}")
+        if rejected:
+            print(f"Rejected rows written to {args.errors or args.file + '.errors.csv'}")
+        return 1 if rejected else 0
+    operation = BATCH_COMMANDS[args.command][0]
+    errors = run_batch(GymStore.load(), operation, read_batch(args.fields, sys.stdin))
+    return 1 if errors else 0
+
+def main(argv=None):
+    global GROUP_COMMIT, SNAPSHOTS
+    args = build_parser().parse_args(argv)
+    if args.metrics:
+        enable_metrics(os.path.abspath(args.metrics), args.metrics_interval)
+    if args.data_dir:
+        os.chdir(args.data_dir)
+    if args.branch:
+        branches = load_branches()
+        if args.branch not in branches:
+            print(f"Unknown branch {args.branch}" + (f", use one of: {', '.join(branches)}" if branches else
+                                                     f", {BRANCHES_FILE} lists none"), file=sys.stderr)
+            return 2
+        os.chdir(branches[args.branch])
+    if args.backend == "sqlite" and args.command != "migrate":
+        use_backend(SQLiteBackend(args.db))
+    if args.group_commit:
+        GROUP_COMMIT = True
+    if args.no_report_cache:
+        REPORT_CACHE.enabled = False
+    if args.no_snapshot:
+        SNAPSHOTS = False
+    if args.command:
+        return timed("command:" + args.command)(run_command)(args)
     if login():
         display_menu()
     else:
@@ -627,6 +3556,7 @@ def main():
         exit()
 
 
-main()
+if __name__ == "__main__":
+    sys.exit(main())
 
 # STOP